@@ -2,25 +2,59 @@
 
 from pathlib import Path
 
-from .od_clean import load_od
-from .od_households import build_household_table
-from .od_people import build_people_table
-from .od_trips import build_trips
-from .taz import generate_taz_assignment
 
+def __getattr__(name):
+    # The TAZ workflow needs geopandas, import it only when used
+    if name == "generate_taz_assignment":
+        from .taz import generate_taz_assignment
 
-def generate_od_tables():
-    """Generate clean OD tables."""
+        return generate_taz_assignment
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def generate_od_tables(census_codes=False, classify_unmapped=False):
+    """Generate clean OD tables.
+    With census_codes, categorical columns of the people and households
+    tables are written as census integer codes. With classify_unmapped,
+    occupation and sector strings not in sector_maps are classified with
+    the sector model (see build_people_table)."""
+
+    # Imported here, so modules used by short jobs (e.g. tree_evaluator)
+    # load without the whole cleaning pipeline and scikit-learn
+    from .census_codes import encode_census
+    from .od_clean import load_od
+    from .od_households import build_household_table
+    from .od_legs import build_legs, summarize_trip_modes
+    from .od_people import build_activity_summary, build_people_table
+    from .od_routes import build_route_ridership
+    from .od_trips import build_trips
 
     opath = Path("data/outputs/od_clean/")
     opath.mkdir(exist_ok=True)
 
     od_df = load_od("data/PIMUS/pimus_final.csv")
 
-    trips, _ = build_trips(od_df)
-    people = build_people_table(od_df, trips, add_informal=True)
+    trips, legs_wide = build_trips(od_df)
+    legs = build_legs(legs_wide)
+    trips = trips.join(summarize_trip_modes(legs))
+    routes = build_route_ridership(legs, trips)
+    activities = build_activity_summary(trips)
+    people = build_people_table(
+        od_df,
+        trips,
+        add_informal=True,
+        classify_unmapped=classify_unmapped,
+        activities=activities,
+    )
     households = build_household_table(od_df, people)
 
+    if census_codes:
+        people = encode_census(people)
+        households = encode_census(households)
+
     trips.to_csv(opath / "trips.csv")
+    legs.to_csv(opath / "legs.csv")
+    routes.to_csv(opath / "routes.csv")
     people.to_csv(opath / "people.csv")
+    activities.to_csv(opath / "activities.csv")
     households.to_csv(opath / "households.csv")
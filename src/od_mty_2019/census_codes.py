@@ -0,0 +1,65 @@
+"""Census code tables for the categorical columns of the people and
+households tables.
+
+Encoded columns are categoricals of integer codes, with the fixed categories
+of od_map_census_codes.yaml, so they take one byte per row and join directly
+against the census synthetic population.
+"""
+
+from importlib import resources
+
+import pandas as pd
+import yaml
+
+with resources.path("od_mty_2019", "od_map_census_codes.yaml") as p:
+    with open(p, "r", encoding="utf-8") as f:
+        census_codes = yaml.load(f, yaml.SafeLoader)
+
+
+def encode_census(df, code_tables=None):
+    """Replaces the labels of the columns in code_tables with their integer
+    codes, as categoricals with all the codes of the table as categories.
+    Labels not in the code table are reported and set to missing.
+
+    Returns a DataFrame with the encoded columns.
+    """
+
+    if code_tables is None:
+        code_tables = census_codes
+
+    encoded = {}
+    for col, table in code_tables.items():
+        if col not in df.columns:
+            continue
+        labels = df[col].astype(object)
+        codes = labels.map(table)
+        unknown = labels.notnull() & codes.isnull()
+        if unknown.sum() > 0:
+            print(
+                f"{unknown.sum()} {col} values not in census codes, set to nan: "
+                f"{sorted(labels[unknown].unique().tolist())}"
+            )
+        encoded[col] = pd.Categorical(codes, categories=sorted(set(table.values())))
+
+    return df.assign(**encoded)
+
+
+def decode_census(df, code_tables=None):
+    """Inverse of encode_census, replaces codes with their labels.
+    Categories are ordered by code."""
+
+    if code_tables is None:
+        code_tables = census_codes
+
+    decoded = {}
+    for col, table in code_tables.items():
+        if col not in df.columns:
+            continue
+        labels = {
+            code: label for label, code in sorted(table.items(), key=lambda x: x[1])
+        }
+        decoded[col] = pd.Categorical(
+            df[col].astype(object).map(labels), categories=list(labels.values())
+        )
+
+    return df.assign(**decoded)
@@ -1,12 +1,51 @@
 """Trains the model to impute formal/informal job trip status."""
 
+from pathlib import Path
 from pickle import dump, load
 
+import numpy as np
 import pandas as pd
-from sklearn.compose import ColumnTransformer
-from sklearn.ensemble import HistGradientBoostingClassifier
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OrdinalEncoder
+
+from .scoring import CHUNKSIZE, load_cached, load_pickle, map_chunks
+from .tree_evaluator import load_trees, predict_proba_trees, predict_trees
+
+MODEL_PATH = Path("data/outputs/informal_model.pkl")
+
+# Fitted trees exported as numpy arrays, see tree_evaluator
+TREES_PATH = Path("data/outputs/informal_model.npz")
+
+ENOE_PATH = Path("data/enoe_clean.csv")
+
+# Mapped and encoded ENOE features
+ENOE_CACHE = Path("data/outputs/enoe_features.pkl")
+
+# Cross validation results of the parameter search
+METRICS_PATH = Path("data/outputs/informal_model_search.csv")
+
+CAT_COLS = ["genero", "ocupacion", "sector", "escolaridad", "municipio"]
+NUM_COLS = ["edad_num"]
+
+MODEL_PARAMS = {
+    "max_iter": 1000,
+    "early_stopping": True,
+    "random_state": 0,
+    "learning_rate": 0.1,
+    "max_leaf_nodes": 5,
+}
+
+PARAM_GRID = {
+    "learning_rate": [0.05, 0.1, 0.2],
+    "max_leaf_nodes": [5, 15, 31],
+    "l2_regularization": [0.0, 1.0],
+}
+
+SCORING = ["neg_log_loss", "roc_auc", "accuracy"]
+
+# Imputed label sets of the informal status
+N_REPLICATES = 20
+
+# Columns of people used by od_to_enoe
+INPUT_COLS = ["CONACT", "SEXO", "SITTRA", "Edad", "ACTIVIDADES_C", "EDUC2", "MUN"]
 
 
 def od_to_enoe(people):
@@ -16,7 +55,6 @@ def od_to_enoe(people):
         people.query("CONACT=='Trabajó'")[
             ["SEXO", "SITTRA", "Edad", "ACTIVIDADES_C", "EDUC2", "MUN"]
         ]
-        .copy()
         .pipe(
             lambda df: df.assign(
                 genero=df.SEXO.map({"M": "H", "F": "F"}),
@@ -69,12 +107,25 @@ def od_to_enoe(people):
     return od_model
 
 
-def train_model():
-    """Trains informal/formal job classification model on enoe data.
-    Saves model as a pickle file.
+def load_enoe(path=ENOE_PATH, cache=ENOE_CACHE):
+    """Reads and maps the clean ENOE data to the model features.
+
+    The mapped features, their ordinal encoding and the target are cached
+    in a pickle file, reused while the ENOE file is unchanged.
+    Returns a dict with X (DataFrame), codes (float array), categories and y.
     """
 
-    enoe = pd.read_csv("data/enoe_clean.csv", index_col=0)
+    path, cache = Path(path), Path(cache)
+    stat = path.stat()
+    stamp = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+    if cache.exists():
+        with open(cache, "rb") as f:
+            enoe = load(f)
+        if enoe["stamp"] == stamp:
+            return enoe
+
+    enoe = pd.read_csv(path, index_col=0)
     y = enoe["informal"]
     X = enoe.drop(columns="informal").pipe(
         lambda df: df.assign(
@@ -91,15 +142,37 @@ def train_model():
         )
     )
 
-    cat_cols_no_edad = [
-        "genero",
-        "ocupacion",
-        "sector",
-        "escolaridad",
-        "municipio",
-    ]
+    # Same encoding as the od_encoder of the pipeline
+    categories = [np.unique(X[c].astype(object).dropna()) for c in CAT_COLS]
+    codes = np.column_stack(
+        [
+            *(
+                pd.Categorical(X[c], categories=cats).codes
+                for c, cats in zip(CAT_COLS, categories)
+            ),
+            X[NUM_COLS].to_numpy(),
+        ]
+    ).astype(np.float64)
 
-    model = Pipeline(
+    enoe = {"stamp": stamp, "X": X, "codes": codes, "categories": categories, "y": y}
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache, "wb") as f:
+        dump(enoe, f, protocol=5)
+
+    return enoe
+
+
+def informal_pipeline(**params):
+    """Informal/formal job classification pipeline.
+    params override the default HistGradientBoostingClassifier parameters."""
+
+    # scikit-learn is only imported to train, exported trees predict without it
+    from sklearn.compose import ColumnTransformer
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OrdinalEncoder
+
+    return Pipeline(
         [
             (
                 "preprocessor",
@@ -111,49 +184,314 @@ def train_model():
                                 handle_unknown="error",
                                 unknown_value=None,
                             ),
-                            cat_cols_no_edad,
+                            CAT_COLS,
                         ),
-                        ("passthrough", "passthrough", ["edad_num"]),
+                        ("passthrough", "passthrough", NUM_COLS),
                     ]
                 ),
             ),
             (
                 "classifier",
-                HistGradientBoostingClassifier(
-                    max_iter=1000,
-                    early_stopping=True,
-                    random_state=0,
-                    learning_rate=0.1,
-                    max_leaf_nodes=5,
-                ),
+                HistGradientBoostingClassifier(**{**MODEL_PARAMS, **params}),
             ),
         ]
     )
 
+
+def search_model(enoe, param_grid=PARAM_GRID, cv=5, n_jobs=-1):
+    """Cross validated grid search of the boosting parameters on the cached
+    ENOE encoding, fitting configurations in parallel on n_jobs processes.
+
+    Returns a DataFrame with a row per configuration with its mean fit time
+    and the mean and std of each score across folds, sorted by log loss.
+    """
+
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    from sklearn.model_selection import GridSearchCV, StratifiedKFold
+
+    search = GridSearchCV(
+        HistGradientBoostingClassifier(**MODEL_PARAMS),
+        param_grid,
+        scoring=SCORING,
+        refit=False,
+        cv=StratifiedKFold(cv, shuffle=True, random_state=0),
+        n_jobs=n_jobs,
+    )
+    search.fit(enoe["codes"], enoe["y"])
+
+    results = pd.DataFrame(search.cv_results_)
+    params = pd.DataFrame(results.params.tolist())
+    cols = ["mean_fit_time"] + [
+        f"{stat}_test_{score}" for score in SCORING for stat in ["mean", "std"]
+    ]
+
+    return pd.concat([params, results[cols]], axis=1).sort_values(
+        "mean_test_neg_log_loss", ascending=False, ignore_index=True
+    )
+
+
+def train_model(search=False):
+    """Trains informal/formal job classification model on enoe data.
+    Saves model as a pickle file, and its trees as numpy arrays.
+
+    With search, boosting parameters are chosen by a cross validated grid
+    search (search_model), whose results are saved as a metrics report.
+    """
+
+    enoe = load_enoe()
+    X, y = enoe["X"], enoe["y"]
+
+    params = {}
+    if search:
+        report = search_model(enoe)
+        report.to_csv(METRICS_PATH, index=False)
+        params = report.loc[[0], list(PARAM_GRID)].to_dict("records")[0]
+        print(f"Best parameters {params}:")
+        print(report.iloc[0].to_string())
+
+    model = informal_pipeline(**params)
     model.fit(X, y)
 
-    with open("data/outputs/informal_model.pkl", "wb") as f:
+    with open(MODEL_PATH, "wb") as f:
         dump(model, f, protocol=5)
 
+    export_trees(model, TREES_PATH, X)
 
-def classify_job(people):
-    """Classify trip as formal or informal.
-    Return DataFrame with added column.
+
+def export_trees(model, path=TREES_PATH, X=None):
+    """Exports the fitted encoder and boosted trees of the model pipeline to
+    a numpy npz file, to be evaluated with tree_evaluator.
+    If X is given, checks the exported trees predict the same labels.
+
+    Returns the exported trees.
+    """
+
+    cat_cols, num_cols, categories = [], [], []
+    for name, transformer, cols in model.named_steps["preprocessor"].transformers_:
+        if name == "od_encoder":
+            cat_cols += list(cols)
+            categories += list(transformer.categories_)
+        elif name != "remainder":
+            num_cols += list(cols)
+
+    classifier = model.named_steps["classifier"]
+    nodes, root, tree_class = [], [], []
+    offset = 0
+    for iteration in classifier._predictors:
+        for k, predictor in enumerate(iteration):
+            if predictor.nodes["is_categorical"].any():
+                raise ValueError("Categorical splits can not be exported.")
+            root.append(offset)
+            tree_class.append(k)
+            tree = predictor.nodes.copy()
+            tree["left"] += offset
+            tree["right"] += offset
+            nodes.append(tree)
+            offset += len(tree)
+    nodes = np.concatenate(nodes)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        feature=nodes["feature_idx"].astype(np.int32),
+        threshold=nodes["num_threshold"].astype(np.float64),
+        left=nodes["left"].astype(np.int32),
+        right=nodes["right"].astype(np.int32),
+        missing_left=nodes["missing_go_to_left"].astype(bool),
+        is_leaf=nodes["is_leaf"].astype(bool),
+        value=nodes["value"].astype(np.float64),
+        root=np.array(root, dtype=np.int32),
+        tree_class=np.array(tree_class, dtype=np.int32),
+        max_depth=nodes["depth"].max(),
+        baseline=classifier._baseline_prediction.ravel(),
+        classes=classifier.classes_,
+        cat_cols=np.array(cat_cols, dtype=str),
+        num_cols=np.array(num_cols, dtype=str),
+        **{
+            f"categories_{c}": np.array(cats, dtype=str)
+            for c, cats in zip(cat_cols, categories)
+        },
+    )
+
+    trees = load_trees(path)
+    if X is not None and not np.array_equal(predict_trees(trees, X), model.predict(X)):
+        raise ValueError("Exported trees do not predict the same labels as model.")
+
+    return trees
+
+
+def load_model(path=MODEL_PATH):
+    """Loads the pickled model, or the exported trees if path is a npz file,
+    once per process.
+    The model is reloaded if the file modification time or size changes."""
+
+    loader = load_trees if Path(path).suffix == ".npz" else load_pickle
+
+    return load_cached(path, loader)
+
+
+def predict_informal(people, path=MODEL_PATH):
+    """Predict formal/informal job status of workers.
+    Returns a Series aligned with people, Blanco por pase for non workers.
     """
 
-    # Avoid modifying inputs
-    people = people.copy()
-    with open("data/outputs/informal_model.pkl", "rb") as f:
-        model = load(f)
+    model = load_model(path)
 
     # Process cleaned OD survey into expected model shape
     od_model = od_to_enoe(people)
 
     # Predict formal/informal labels
-    od_model["informal"] = model.predict(od_model)
+    informal = pd.Series(index=od_model.index, dtype=object)
+    if len(od_model) > 0 and isinstance(model, dict):
+        informal[:] = predict_trees(model, od_model)
+    elif len(od_model) > 0:
+        informal[:] = model.predict(od_model)
+
+    return informal.reindex(people.index).fillna("Blanco por pase").rename("informal")
+
+
+def predict_informal_proba(people, path=MODEL_PATH):
+    """Predicted probability of each job status label for workers.
+    Returns a DataFrame indexed by the workers of people, with a column per
+    model label."""
+
+    model = load_model(path)
+    od_model = od_to_enoe(people)
+
+    if isinstance(model, dict):
+        classes = model["classes"]
+        proba = predict_proba_trees(model, od_model) if len(od_model) > 0 else None
+    else:
+        classes = model.classes_
+        proba = model.predict_proba(od_model) if len(od_model) > 0 else None
+
+    return pd.DataFrame(
+        proba if proba is not None else np.zeros((0, len(classes))),
+        index=od_model.index,
+        columns=classes,
+    )
+
+
+def impute_informal(people, n_replicates=N_REPLICATES, seed=0, path=MODEL_PATH):
+    """Multiple imputation of the job status of workers.
+
+    Probabilities are predicted once and n_replicates label sets are drawn
+    from them in a single vectorized draw, reproducible with seed.
+    Returns an int8 DataFrame indexed by the workers of people with a column
+    per replicate, holding the position of the label in the model labels
+    (for the informal model 0 formal, 1 informal).
+    """
+
+    proba = predict_informal_proba(people, path)
+    cum = proba.to_numpy().cumsum(axis=1)[:, :-1]
+
+    rng = np.random.default_rng(seed)
+    u = rng.random((len(proba), n_replicates, 1))
+    replicates = (u >= cum[:, None, :]).sum(axis=2).astype(np.int8)
+
+    return pd.DataFrame(replicates, index=proba.index)
+
+
+def informal_totals(replicates, weights, by):
+    """Weighted number of informal workers in each group, from the imputed
+    replicates of impute_informal.
 
-    people["informal"] = (
-        od_model["informal"].reindex(people.index).fillna("Blanco por pase")
+    weights (e.g. the FACTOR of each person) and by (e.g. TAZ_TRAB) are
+    aligned with the replicates index. Returns a DataFrame indexed by group
+    with the mean total across replicates (informal), the between replicate
+    variance (var_between) and the imputation variance of the mean,
+    (1 + 1/m) times var_between for m replicates (var_imputation).
+    """
+
+    weights = pd.Series(weights).reindex(replicates.index)
+    by = pd.Series(by).reindex(replicates.index)
+    m = replicates.shape[1]
+
+    totals = replicates.mul(weights, axis=0).groupby(by, observed=True).sum()
+    var_between = totals.var(axis=1, ddof=1)
+
+    return pd.DataFrame(
+        {
+            "informal": totals.mean(axis=1),
+            "var_between": var_between,
+            "var_imputation": (1 + 1 / m) * var_between,
+        }
     )
 
-    return people
+
+def classify_job(people, path=MODEL_PATH):
+    """Classify trip as formal or informal.
+    Return DataFrame with added column.
+    """
+
+    return people.assign(informal=predict_informal(people, path))
+
+
+def _read_chunks(src, columns, chunksize):
+    """Reads columns of a Parquet or CSV file in chunks of chunksize rows."""
+
+    src = Path(src)
+    if src.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(src).iter_batches(
+            batch_size=chunksize, columns=columns
+        ):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(src, usecols=columns, chunksize=chunksize)
+
+
+def _predict_chunk(chunk, id_cols, path):
+    """Predicts a chunk of people in a worker process."""
+
+    return predict_informal(chunk.set_index(id_cols), path).reset_index()
+
+
+def classify_job_batch(
+    src,
+    dst,
+    id_cols=("HOGAR", "HABITANTE"),
+    path=MODEL_PATH,
+    chunksize=CHUNKSIZE,
+    n_jobs=None,
+):
+    """Predicts formal/informal job status of a people file too large for
+    memory, such as the synthetic population.
+
+    People are read from src (Parquet or CSV) in chunks of chunksize rows,
+    predicted on n_jobs worker processes (all cores by default) and written
+    to dst, in input order, as the id_cols and informal columns. At most two
+    chunks per worker are in memory at once.
+    """
+
+    id_cols = list(id_cols)
+    dst = Path(dst)
+    chunks = _read_chunks(src, id_cols + INPUT_COLS, chunksize)
+
+    writer = None
+    first = True
+
+    def write(pred):
+        nonlocal writer, first
+        if dst.suffix == ".parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(
+                pred.astype({"informal": str}), preserve_index=False
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(dst, table.schema)
+            writer.write_table(table)
+        else:
+            pred.to_csv(dst, mode="w" if first else "a", header=first, index=False)
+        first = False
+
+    try:
+        for pred in map_chunks(_predict_chunk, chunks, id_cols, path, n_jobs=n_jobs):
+            write(pred)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -1,6 +1,7 @@
 """Generate the households table from a clean OD dataframe."""
 
 import numpy as np
+import pandas as pd
 
 
 def build_household_table(od_df, people):
@@ -35,52 +36,55 @@ def build_household_table(od_df, people):
 
     viv_df["NumberOfVehicles"] = viv_df.VHAuto + viv_df.VHPickup + viv_df.VHMoto
 
-    # Auxiliary columns to fix household counts
-    viv_df["HabitantesObs"] = people.groupby(["HOGAR"]).size()
-    viv_df["Hab14masTrabajoObs"] = (
-        people.query("Edad >= 14 & CONACT == 'Trabajó'").groupby(["HOGAR"]).size()
-    )
-    viv_df["Hab14masTrabajoObs"] = viv_df["Hab14masTrabajoObs"].fillna(0.0)
-    viv_df["Hab14masNTrabajoObs"] = (
-        people.query("Edad >= 14 & CONACT != 'Trabajó'").groupby(["HOGAR"]).size()
+    # Auxiliary columns to fix household counts, in a single groupby
+    is_14mas = people.Edad >= 14
+    trabajo = people.CONACT == "Trabajó"
+    counts = (
+        pd.DataFrame(
+            {
+                "HabitantesObs": 1,
+                "Hab14masTrabajoObs": is_14mas & trabajo,
+                "Hab14masNTrabajoObs": is_14mas & ~trabajo,
+            },
+            index=people.index,
+        )
+        .groupby(level="HOGAR")
+        .sum()
+        .reindex(viv_df.index)
     )
-    viv_df["Hab14masNTrabajoObs"] = viv_df["Hab14masNTrabajoObs"].fillna(0.0)
+    viv_df["HabitantesObs"] = counts.HabitantesObs
+    viv_df["Hab14masTrabajoObs"] = counts.Hab14masTrabajoObs.fillna(0.0)
 
     # Fix counts
-    viv_df_2 = viv_df.copy()
-
-    viv_df_2["Hab14masTrabajo"] = viv_df_2.Hab14masTrabajo.mask(
+    hab14_trabajo = viv_df.Hab14masTrabajo.mask(
         viv_df.Hab14masTrabajo < viv_df.Hab14masTrabajoObs, viv_df.Hab14masTrabajoObs
     )
-
-    viv_df_2["HbitantesMayor6"] = viv_df_2.HbitantesMayor6.mask(
-        viv_df_2.HabitantesObs > viv_df_2.HbitantesMayor6, viv_df_2.HabitantesObs
-    )
-
-    viv_df_2["HabitantesTotal"] = viv_df_2.HbitantesMenor5 + viv_df_2.HbitantesMayor6
-
-    viv_df_2["Hab14masTrabajoSup"] = (
-        viv_df_2.HbitantesMayor6 - viv_df_2.Hab14masNTrabajoObs
+    mayor6 = viv_df.HbitantesMayor6.mask(
+        viv_df.HabitantesObs > viv_df.HbitantesMayor6, viv_df.HabitantesObs
     )
-    viv_df_2["Hab14masTrabajo"] = viv_df_2.Hab14masTrabajo.mask(
-        viv_df_2.Hab14masTrabajo > viv_df_2.Hab14masTrabajoSup,
-        viv_df_2.Hab14masTrabajoSup,
+    total = viv_df.HbitantesMenor5 + mayor6
+    hab14_trabajo_sup = mayor6 - counts.Hab14masNTrabajoObs.fillna(0.0)
+    hab14_trabajo = hab14_trabajo.mask(
+        hab14_trabajo > hab14_trabajo_sup, hab14_trabajo_sup
     )
 
-    perc_adj = (
-        ((viv_df_2.drop(columns="Hab14masTrabajoSup") != viv_df).sum(axis=1) > 0).sum()
-        / len(viv_df)
-        * 100
-    )
+    adjusted = pd.Series(False, index=viv_df.index)
+    for col, fixed in [
+        ("Hab14masTrabajo", hab14_trabajo),
+        ("HbitantesMayor6", mayor6),
+        ("HabitantesTotal", total),
+    ]:
+        adjusted |= viv_df[col].ne(fixed) & ~(viv_df[col].isnull() & fixed.isnull())
+        viv_df[col] = fixed
+
+    perc_adj = adjusted.sum() / len(viv_df) * 100
     print(f"{perc_adj}% of households have been ajusted.")
 
     perc_incom = (
-        (viv_df_2.HabitantesObs != viv_df_2.HbitantesMayor6).sum() / len(viv_df) * 100
+        (viv_df.HabitantesObs != viv_df.HbitantesMayor6).sum() / len(viv_df) * 100
     )
     print(f"{perc_incom} of households are missing members " "above 6 years of age.")
 
-    viv_df = viv_df_2.drop(columns=["Hab14masTrabajoSup", "Hab14masNTrabajoObs"])
-
     viv_df = viv_df.rename(columns={"LineaTelef": "TELEFONO", "Internet": "INTERNET"})
     viv_df["AUTOPROP"] = (
         (viv_df.VHAuto + viv_df.VHPickup).astype(bool).map({True: "Sí", False: "No"})
@@ -1,285 +1,160 @@
 """Changes the leg table from wide to long format.
 Fixes issued with leg data."""
 
-import numpy as np
 import pandas as pd
 
+from .od_modes import (
+    MODE_HIERARCHY,
+    clean_tipo_transp,
+    clean_transp,
+    map_unique,
+    mode_group,
+    transp_mode,
+)
+
+# Number of legs (tramos) reported per trip
+N_LEGS = 6
+
+# Leg attributes, as named after removing the M{n} leg prefix.
+# The first leg has no TpoTranspordo column.
+LEG_COLS = [
+    "Transp",
+    "TpoTranspordo",
+    "TipoTransp",
+    "Transp_O",
+    "Tpo_Caminata",
+    "N_Ruta",
+    "HHTpoParada",
+    "MMTpoParada",
+    "HHTpoAbordo",
+    "HHTpoAbordo_O",
+    "MMTpoAbordo",
+    "Pago",
+]
+
+
+def wide_leg_col(tramo, col):
+    """Column name of leg attribute col for leg number tramo in the wide table."""
+
+    if col in ["Tpo_Caminata", "N_Ruta"]:
+        return f"M{tramo}{col}"
+    return f"M{tramo}_{col}"
+
+
+def wide_leg_cols():
+    """All leg columns present in the wide od table, in leg order."""
+
+    return [
+        wide_leg_col(tramo, col)
+        for tramo in range(1, N_LEGS + 1)
+        for col in LEG_COLS
+        if not (tramo == 1 and col == "TpoTranspordo")
+    ]
+
 
 def build_legs(legs_wide):
     """Changes the leg table from wide to long format.
-    Fixes issued with leg data."""
+    Fixes issued with leg data.
 
-    m1_cols = [
-        "M1_Transp",
-        "M1_TipoTransp",
-        "M1_Transp_O",
-        "M1Tpo_Caminata",
-        "M1N_Ruta",
-        "M1_HHTpoParada",
-        "M1_MMTpoParada",
-        "M1_HHTpoAbordo",
-        "M1_HHTpoAbordo_O",
-        "M1_MMTpoAbordo",
-        "M1_Pago",
-    ]
-    m2_cols = [
-        "M2_Transp",
-        "M2_TpoTranspordo",
-        "M2_TipoTransp",
-        "M2_Transp_O",
-        "M2Tpo_Caminata",
-        "M2N_Ruta",
-        "M2_HHTpoParada",
-        "M2_MMTpoParada",
-        "M2_HHTpoAbordo",
-        "M2_HHTpoAbordo_O",
-        "M2_MMTpoAbordo",
-        "M2_Pago",
-    ]
-    m3_cols = [
-        "M3_Transp",
-        "M3_TpoTranspordo",
-        "M3_TipoTransp",
-        "M3_Transp_O",
-        "M3Tpo_Caminata",
-        "M3N_Ruta",
-        "M3_HHTpoParada",
-        "M3_MMTpoParada",
-        "M3_HHTpoAbordo",
-        "M3_HHTpoAbordo_O",
-        "M3_MMTpoAbordo",
-        "M3_Pago",
-    ]
-    m4_cols = [
-        "M4_Transp",
-        "M4_TpoTranspordo",
-        "M4_TipoTransp",
-        "M4_Transp_O",
-        "M4Tpo_Caminata",
-        "M4N_Ruta",
-        "M4_HHTpoParada",
-        "M4_MMTpoParada",
-        "M4_HHTpoAbordo",
-        "M4_HHTpoAbordo_O",
-        "M4_MMTpoAbordo",
-        "M4_Pago",
-    ]
-    m5_cols = [
-        "M5_Transp",
-        "M5_TpoTranspordo",
-        "M5_TipoTransp",
-        "M5_Transp_O",
-        "M5Tpo_Caminata",
-        "M5N_Ruta",
-        "M5_HHTpoParada",
-        "M5_MMTpoParada",
-        "M5_HHTpoAbordo",
-        "M5_HHTpoAbordo_O",
-        "M5_MMTpoAbordo",
-        "M5_Pago",
-    ]
-    m6_cols = [
-        "M6_Transp",
-        "M6_TpoTranspordo",
-        "M6_TipoTransp",
-        "M6_Transp_O",
-        "M6Tpo_Caminata",
-        "M6N_Ruta",
-        "M6_HHTpoParada",
-        "M6_MMTpoParada",
-        "M6_HHTpoAbordo",
-        "M6_HHTpoAbordo_O",
-        "M6_MMTpoAbordo",
-        "M6_Pago",
-    ]
+    The M1 to M6 column blocks are stacked in a single reshape, a TRAMO level
+    is appended to the trip index, and cleanup is applied once to all legs.
+    """
 
-    legs1 = legs_wide[m1_cols].rename(columns=lambda c: c.replace("M1", "").strip("_"))
-    legs2 = legs_wide[m2_cols].rename(columns=lambda c: c.replace("M2", "").strip("_"))
-    legs3 = legs_wide[m3_cols].rename(columns=lambda c: c.replace("M3", "").strip("_"))
-    legs4 = legs_wide[m4_cols].rename(columns=lambda c: c.replace("M4", "").strip("_"))
-    legs5 = legs_wide[m5_cols].rename(columns=lambda c: c.replace("M5", "").strip("_"))
-    legs6 = legs_wide[m6_cols].rename(columns=lambda c: c.replace("M6", "").strip("_"))
+    # Reshape to long, missing M1_TpoTranspordo is filled with nans
+    tramos = range(1, N_LEGS + 1)
+    legs = legs_wide.reindex(
+        columns=[wide_leg_col(tramo, col) for tramo in tramos for col in LEG_COLS]
+    )
+    legs.columns = pd.MultiIndex.from_product([tramos, LEG_COLS], names=["TRAMO", None])
+    legs = legs.stack("TRAMO", future_stack=True)
 
-    nan_vals = [
-        0,
-        False,
-        "0",
-        "no utilizó otro modo de transporte",
-        "no utilizó otro modo de transporte",
-        "no utilizo otro medio de transporte",
-        "no utilizó otro medio de transporte",
-    ]
-    for legs in [legs1, legs2, legs3, legs4, legs5, legs6]:
-        legs.loc[:, "TipoTransp"] = (
-            legs.loc[:, "TipoTransp"]
-            .str.strip()
-            .str.lower()
-            .str.normalize("NFKD")
-            .replace(nan_vals, np.nan)
-            .replace("transporte público", "público")
-            .replace("vehículo particular", "particular")
-            .replace("a pie (caminando)", "caminó")
-            .replace("transpote por aplicación", "transporte por aplicación")
-        )
+    # Values set by the fixes below must be categories, "caminó" is
+    # set both in NFD and NFC forms
+    legs["TipoTransp"] = map_unique(
+        legs.TipoTransp, clean_tipo_transp, ["caminó", "caminó", "otro modo"]
+    )
+    legs["Transp"] = map_unique(legs.Transp, clean_transp, ["otro"])
+    legs["TpoAbordo"] = (
+        legs[["HHTpoAbordo", "HHTpoAbordo_O"]].max(axis=1) * 60 + legs.MMTpoAbordo
+    )
+    legs["TpoParada"] = legs.HHTpoParada * 60 + legs.MMTpoParada
+    legs = legs.drop(
+        columns=[
+            "HHTpoAbordo",
+            "HHTpoAbordo_O",
+            "MMTpoAbordo",
+            "HHTpoParada",
+            "MMTpoParada",
+        ]
+    )
 
-        legs.loc[:, "Transp"] = (
-            legs.loc[:, "Transp"]
-            .str.strip()
-            .str.lower()
-            .str.normalize("NFKD")
-            .replace(nan_vals, np.nan)
-            .replace("autobús  suburbano", "autobús suburbano")
-            .replace("uber, cabify , didi o similar", "uber, cabify, didi, o similar")
-        )
-        legs["TpoAbordo"] = (
-            legs[["HHTpoAbordo", "HHTpoAbordo_O"]].max(axis=1) * 60 + legs.MMTpoAbordo
-        )
-        legs["TpoParada"] = legs.HHTpoParada * 60 + legs.MMTpoParada
-        legs.drop(
-            columns=[
-                "HHTpoAbordo",
-                "HHTpoAbordo_O",
-                "MMTpoAbordo",
-                "HHTpoParada",
-                "MMTpoParada",
-            ],
-            inplace=True,
-        )
+    tramo = legs.index.get_level_values("TRAMO")
+    walk = legs.Transp == "a pie (caminando)"
 
-    legs6 = legs6.dropna(subset="Transp")
-    legs5 = legs5.dropna(subset="Transp")
-    legs4 = legs4.dropna(subset="Transp")
     # Legs 4 have mislabeled walking legs
-    legs4.loc[
-        (legs4.Transp == "a pie (caminando)") & legs4.TipoTransp.isna(), "TipoTransp"
-    ] = "caminó"
+    legs.loc[(tramo == 4) & walk & legs.TipoTransp.isna(), "TipoTransp"] = "caminó"
     # Legs 3 has a mislabled leg
-    legs3.loc[legs3.Transp.notnull() & legs3.TipoTransp.isna(), "TipoTransp"] = "caminó"
-    legs3 = legs3.dropna(subset="Transp")
-    legs2 = legs2.dropna(subset="Transp")
-    legs2.loc[("59928-4", 2, 2), "TipoTransp"] = "otro modo"
-    legs2 = legs2.dropna(subset="TipoTransp")
-    legs2 = legs2.drop(index=("35090-30", 2, 2))
+    legs.loc[
+        (tramo == 3) & legs.Transp.notnull() & legs.TipoTransp.isna(), "TipoTransp"
+    ] = "caminó"
+    legs.loc[("59928-4", 2, 2, 2), "TipoTransp"] = "otro modo"
 
     # For Legs1, many legs seem
     # to mix walk first leg to
     # another mode, reported in TipoTransp
-    cond = (
-        (legs1.Transp == "a pie (caminando)")
-        & (legs1.TipoTransp == "otro modo")
-        & (legs1.TpoAbordo == 0)
-    )
-    legs1.loc[cond, "TipoTransp"] = "caminó"
+    cond = (tramo == 1) & walk & (legs.TipoTransp == "otro modo")
+    legs.loc[cond & (legs.TpoAbordo == 0), "TipoTransp"] = "caminó"
+    legs.loc[cond & (legs.TpoAbordo > 0), "Transp"] = "otro"
 
-    cond = (
-        (legs1.Transp == "a pie (caminando)")
-        & (legs1.TipoTransp == "otro modo")
-        & (legs1.TpoAbordo > 0)
+    # Drop unused legs, the first leg is always kept
+    keep = (tramo == 1) | (
+        legs.Transp.notnull() & ((tramo != 2) | legs.TipoTransp.notnull())
     )
-    legs1.loc[cond, "Transp"] = "otro"
-
-    # return legs1, legs2, legs3, legs4, legs5, legs6
+    legs = legs[keep].drop(index=("35090-30", 2, 2, 2)).sort_index()
 
-    # nnans = legs6.replace(nan_cols, np.nan).T.isna().sum()
-    # legs6 = legs6[(nnans < 12)].copy()
-    # return legs6
+    legs["Transp"] = map_unique(legs.Transp, transp_mode)
+    legs["MODO"] = map_unique(legs.Transp, mode_group).cat.set_categories(
+        MODE_HIERARCHY
+    )
 
-    # nnans = legs5.replace(nan_cols, np.nan).T.isna().sum()
-    # legs5 = legs5[(nnans < 11)].copy()
+    return legs
 
-    # nnans = legs4.replace(nan_cols, np.nan).T.isna().sum()
-    # legs4 = legs4[(nnans < 12)].copy()
 
-    # nnans = legs3.replace(nan_cols, np.nan).T.isna().sum()
-    # legs3 = legs3[(nnans < 11)].copy()
+def summarize_trip_modes(legs):
+    """Derives trip level mode attributes from the long legs table.
 
-    # legs2 = legs2.query(
-    #     "Transp != 'No utilizó otro medio de transporte'"
-    # ).copy()
+    MODO_PRINCIPAL is the leg mode ranked highest in MODE_HIERARCHY,
+    MODO_ACCESO and MODO_EGRESO are the modes of the first and last legs,
+    and TRANSBORDOS counts non walking legs after the first one.
+    Returns a DataFrame indexed by HOGAR, HABITANTE, VIAJE.
+    """
 
-    legs1 = legs1.assign(TRAMO=1).set_index("TRAMO", append=True)
-    legs2 = legs2.assign(TRAMO=2).set_index("TRAMO", append=True)
-    legs3 = legs3.assign(TRAMO=3).set_index("TRAMO", append=True)
-    legs4 = legs4.assign(TRAMO=4).set_index("TRAMO", append=True)
-    legs5 = legs5.assign(TRAMO=5).set_index("TRAMO", append=True)
-    legs6 = legs6.assign(TRAMO=6).set_index("TRAMO", append=True)
+    trip_levels = ["HOGAR", "HABITANTE", "VIAJE"]
+    modo = legs.MODO.astype(pd.CategoricalDtype(MODE_HIERARCHY))
 
-    legs = pd.concat([legs2, legs3, legs4, legs5, legs6, legs1], axis=0).sort_index()
+    # Category codes are the hierarchy rank, nans are ranked last
+    rank = pd.Series(modo.cat.codes, index=legs.index).replace(-1, len(MODE_HIERARCHY))
+    main_rank = rank.groupby(level=trip_levels).min()
+    main_rank = main_rank.where(main_rank < len(MODE_HIERARCHY), -1)
 
-    legs["Transp"] = (
-        legs.Transp.str.strip()
-        .replace(
-            [
-                "taxi",
-                "Caminó",
-                "Autobús foráneo",
-                "Automóvil (Pasajero)",
-                "Automóvil (conductor)",
-                "Metro Enlace",
-                "Automóvil\xa0(Conductor)",
-                "Automóvil\xa0(pasajero)",
-                "Motocicleta (conductor)",
-                "Uber, Cabify, Didi, o similar",
-                "Autobús  Suburbano",
-                "Transporte de personal",
-            ],
-            [
-                "Taxi",
-                "A pie (caminando)",
-                "Autobús Foráneo",
-                "Automóvil (pasajero)",
-                "Automóvil (Conductor)",
-                "Metro enlace",
-                "Automóvil (Conductor)",
-                "Automóvil (pasajero)",
-                "Motocicleta (Conductor)",
-                "Uber, Cabify , Didi o similar",
-                "Autobús Suburbano",
-                "Transporte de Personal",
-            ],
-        )
-        .replace(
-            [
-                "A pie (caminando)",
-                "Uber, Cabify , Didi o similar",
-                "Automóvil (Conductor)",
-                "Automóvil (pasajero)",
-                "Autobús Suburbano",
-                "Camión Urbano",
-                "Ecovía",
-                "Metrobús",
-                "Metrorrey",
-                "Microbús",
-                "Transmetro",
-                "Transporte Público",
-                "Metro enlace",
-                "Motocicleta (Conductor)",
-                "Motocicleta (pasajero)",
-                "Bicicleta",
-                "Autobús Foráneo",
-                "Otro",
-            ],
-            [
-                "caminando",
-                "app",
-                "auto",
-                "auto",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "TPUB",
-                "moto",
-                "moto",
-                "bici",
-                "otro",
-                "otro",
-            ],
-        )
+    grouped = modo.groupby(level=trip_levels)
+    # nth keeps missing modes of the first and last legs, first/last skip them
+    ordered = modo.sort_index(level="TRAMO", sort_remaining=False).groupby(
+        level=trip_levels
+    )
+    moving = (modo.notnull() & (modo != "caminando")).groupby(level=trip_levels)
+
+    trip_modes = pd.DataFrame(
+        {
+            "MODO_PRINCIPAL": pd.Categorical.from_codes(
+                main_rank, categories=MODE_HIERARCHY
+            ),
+            "MODO_ACCESO": ordered.nth(0).droplevel("TRAMO"),
+            "MODO_EGRESO": ordered.nth(-1).droplevel("TRAMO"),
+            "NTRAMOS": grouped.size(),
+            "TRANSBORDOS": (moving.sum() - 1).clip(lower=0),
+        },
+        index=main_rank.index,
     )
 
-    return legs
+    return trip_modes
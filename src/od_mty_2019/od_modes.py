@@ -0,0 +1,195 @@
+"""Normalization of transport mode labels shared by the trips and legs tables.
+
+Mode columns hold a few dozen distinct labels over hundreds of thousands of
+cells. Cleanup functions are applied to the unique values only, results are
+memoized for the life of the process, and columns are rebuilt as categoricals.
+"""
+
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Labels meaning no leg was reported
+NAN_VALS = [
+    0,
+    False,
+    "0",
+    "no utilizó otro modo de transporte",
+    "no utilizó otro modo de transporte",
+    "no utilizo otro medio de transporte",
+    "no utilizó otro medio de transporte",
+]
+
+# Sequential fixes of TipoTransp (mode type) labels
+TIPO_TRANSP_FIXES = [
+    ("transporte público", "público"),
+    ("vehículo particular", "particular"),
+    ("a pie (caminando)", "caminó"),
+    ("transpote por aplicación", "transporte por aplicación"),
+]
+
+# Sequential fixes of Transp (mode) labels
+TRANSP_FIXES = [
+    ("autobús  suburbano", "autobús suburbano"),
+    ("uber, cabify , didi o similar", "uber, cabify, didi, o similar"),
+]
+
+# Homologation of Transp typos
+TRANSP_TYPOS = {
+    "taxi": "Taxi",
+    "Caminó": "A pie (caminando)",
+    "Autobús foráneo": "Autobús Foráneo",
+    "Automóvil (Pasajero)": "Automóvil (pasajero)",
+    "Automóvil (conductor)": "Automóvil (Conductor)",
+    "Metro Enlace": "Metro enlace",
+    "Automóvil\xa0(Conductor)": "Automóvil (Conductor)",
+    "Automóvil\xa0(pasajero)": "Automóvil (pasajero)",
+    "Motocicleta (conductor)": "Motocicleta (Conductor)",
+    "Uber, Cabify, Didi, o similar": "Uber, Cabify , Didi o similar",
+    "Autobús  Suburbano": "Autobús Suburbano",
+    "Transporte de personal": "Transporte de Personal",
+}
+
+# Grouping of Transp into modes
+TRANSP_MODES = {
+    "A pie (caminando)": "caminando",
+    "Uber, Cabify , Didi o similar": "app",
+    "Automóvil (Conductor)": "auto",
+    "Automóvil (pasajero)": "auto",
+    "Autobús Suburbano": "TPUB",
+    "Camión Urbano": "TPUB",
+    "Ecovía": "TPUB",
+    "Metrobús": "TPUB",
+    "Metrorrey": "TPUB",
+    "Microbús": "TPUB",
+    "Transmetro": "TPUB",
+    "Transporte Público": "TPUB",
+    "Metro enlace": "TPUB",
+    "Motocicleta (Conductor)": "moto",
+    "Motocicleta (pasajero)": "moto",
+    "Bicicleta": "bici",
+    "Autobús Foráneo": "otro",
+    "Otro": "otro",
+}
+
+# Mode groups from highest to lowest priority when choosing a trip main mode
+MODE_HIERARCHY = [
+    "TPUB",
+    "transporte de personal",
+    "app",
+    "taxi",
+    "auto",
+    "moto",
+    "otro",
+    "bici",
+    "caminando",
+]
+
+
+def _mode_key(v):
+    """Lookup key of a Transp label, insensitive to case, unicode form and
+    repeated spaces."""
+
+    return " ".join(unicodedata.normalize("NFKC", v).lower().split())
+
+
+# Mode group of Transp labels and of the groups themselves, keyed by _mode_key
+MODE_GROUPS = {
+    **{_mode_key(k): v for k, v in TRANSP_MODES.items()},
+    **{
+        _mode_key(k): TRANSP_MODES[v]
+        for k, v in TRANSP_TYPOS.items()
+        if v in TRANSP_MODES
+    },
+    **{_mode_key(group): group for group in MODE_HIERARCHY},
+}
+
+
+def map_unique(s, func, extra_categories=()):
+    """Applies func to the unique values of Series s only.
+
+    Nans are not passed to func, func may return nan.
+    Returns a categorical Series aligned with s. Values to be assigned later
+    to the column can be added as categories with extra_categories.
+    """
+
+    codes, uniques = pd.factorize(s)
+    mapped = pd.Index([func(u) for u in uniques], dtype=object)
+    categories = mapped.dropna().append(pd.Index(extra_categories, dtype=object))
+    categories = categories.unique()
+    # Code -1 (nan) indexes the appended -1
+    new_codes = np.append(categories.get_indexer(mapped), -1)[codes]
+
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=categories),
+        index=s.index,
+        name=s.name,
+    )
+
+
+@lru_cache(maxsize=None)
+def strip_lower(v):
+    """Strips and lower cases a label, non string labels are nan."""
+
+    if not isinstance(v, str):
+        return np.nan
+    return v.strip().lower()
+
+
+@lru_cache(maxsize=None)
+def normalize_label(v):
+    """Strips, lower cases and NFKD normalizes a label."""
+
+    v = strip_lower(v)
+    if not isinstance(v, str):
+        return v
+    return unicodedata.normalize("NFKD", v)
+
+
+def _fix_label(v, fixes):
+    """Normalizes label v and applies fixes in order."""
+
+    v = normalize_label(v)
+    if v in NAN_VALS:
+        return np.nan
+    for old, new in fixes:
+        if v == old:
+            v = new
+    return v
+
+
+@lru_cache(maxsize=None)
+def clean_tipo_transp(v):
+    """Cleans a TipoTransp label."""
+
+    return _fix_label(v, TIPO_TRANSP_FIXES)
+
+
+@lru_cache(maxsize=None)
+def clean_transp(v):
+    """Cleans a Transp label."""
+
+    return _fix_label(v, TRANSP_FIXES)
+
+
+@lru_cache(maxsize=None)
+def transp_mode(v):
+    """Maps a clean Transp label to its mode group."""
+
+    if not isinstance(v, str):
+        return np.nan
+    v = v.strip()
+    v = TRANSP_TYPOS.get(v, v)
+    return TRANSP_MODES.get(v, v)
+
+
+@lru_cache(maxsize=None)
+def mode_group(v):
+    """Maps any Transp label to its group in MODE_HIERARCHY.
+    Unknown labels are grouped as otro."""
+
+    if not isinstance(v, str):
+        return np.nan
+    return MODE_GROUPS.get(_mode_key(v), "otro")
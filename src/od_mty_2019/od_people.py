@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 import yaml
 
-from .informal_model import classify_job
+from .informal_model import predict_informal
 
 with resources.path("od_mty_2019", "od_map_parentesco.yaml") as p:
     with open(p, "r", encoding="utf-8") as f:
@@ -14,34 +14,202 @@ with resources.path("od_mty_2019", "od_map_parentesco.yaml") as p:
 with resources.path("od_mty_2019", "od_map_dis.yaml") as p:
     with open(p, "r", encoding="utf-8") as f:
         dis_map = yaml.load(f, yaml.SafeLoader)
-from .sector_maps import ocu_only_map, sect_map
+with resources.path("od_mty_2019", "od_map_people_overrides.yaml") as p:
+    with open(p, "r", encoding="utf-8") as f:
+        people_overrides = yaml.load(f, yaml.SafeLoader)
+from .sector_maps import ocu_only_inv, sect_map
+from .sector_model import classify_ocupacion, classify_sector
+
+
+def apply_overrides(people, name, mask):
+    """Sets hand recoded values of override table name from
+    od_map_people_overrides.yaml.
+
+    Keyed tables are joined on (HOGAR, HABITANTE), keys must be unique and
+    exist in people, rows in mask not in the table are reported.
+    Tables without keys are assigned to the rows in mask by position, which
+    requires rows in the same order and number as when the values were
+    recorded. Their keys are printed so they can be pinned in the yaml file.
+    """
+
+    table = people_overrides[name]
+    cols = table["cols"]
+    values = pd.DataFrame(table["values"], columns=cols, dtype=object)
+
+    if table["keys"]:
+        if len(table["keys"]) != len(values):
+            raise ValueError(
+                f"Override table {name} has {len(table['keys'])} keys "
+                f"for {len(values)} values."
+            )
+        values.index = pd.MultiIndex.from_tuples(
+            map(tuple, table["keys"]), names=["HOGAR", "HABITANTE"]
+        )
+        duplicated = values.index[values.index.duplicated()]
+        if len(duplicated) > 0:
+            raise ValueError(
+                f"Override keys of {name} are not unique: {list(duplicated)}"
+            )
+        missing = values.index.difference(people.index)
+        if len(missing) > 0:
+            raise KeyError(f"Override keys of {name} not in people: {list(missing)}")
+        not_keyed = people.index[mask].difference(values.index)
+        if len(not_keyed) > 0:
+            print(f"{len(not_keyed)} rows not in override table {name}.")
+    else:
+        if mask.sum() != len(values):
+            raise ValueError(
+                f"Override table {name} has {len(values)} values "
+                f"for {mask.sum()} rows."
+            )
+        values.index = people.index[mask]
+        print(
+            f"Override table {name} is positional, keys: "
+            f"{[list(k) for k in values.index]}"
+        )
+
+    people.loc[values.index, cols] = values
+
+    return people
+
+
+def find_conflicts(df, cols, by=("HOGAR", "HABITANTE")):
+    """Finds persons with conflicting values of cols across their rows in df.
+
+    Rows are hashed on cols, only persons with more than one distinct hash
+    are inspected column by column. Missing values are not conflicts.
+    Returns a long DataFrame indexed by by and column, with one row per
+    distinct conflicting value.
+    """
 
+    by = list(by)
+    df = df.reset_index()[by + cols]
 
-def get_educ_asi(r):
+    row_hash = pd.util.hash_pandas_object(df[cols], index=False)
+    n_hashes = row_hash.groupby([df[b] for b in by]).transform("nunique")
+
+    long = (
+        df[n_hashes.to_numpy() > 1]
+        .melt(id_vars=by, value_vars=cols, var_name="column", value_name="value")
+        .dropna(subset="value")
+        .drop_duplicates()
+    )
+    n_values = long.groupby(by + ["column"]).value.transform("size")
+
+    return long[n_values > 1].set_index(by + ["column"]).sort_index()
+
+
+def build_activity_summary(trips):
+    """Summarizes the trips of each person by purpose (Motivo).
+
+    Returns a DataFrame indexed by HOGAR, HABITANTE, Motivo with the first
+    destination zone, maximum duration, number of trips and first departure
+    time, computed in a single grouped pass.
+    """
+
+    return trips.groupby(["HOGAR", "HABITANTE", "Motivo"]).agg(
+        ZonaDest=("ZonaDest", "first"),
+        duracion_max=("duracion", "max"),
+        n_viajes=("duracion", "size"),
+        fecha_inicio=("fecha_inicio", "first"),
+    )
+
+
+def tie_traslado(duracion):
+    """Census travel time category (TIE_TRASLADO_*) of trip durations."""
+
+    return pd.cut(
+        duracion.dt.total_seconds() / 60,
+        [-1, 15, 30, 60, 120, 1e6],
+        labels=[
+            "Hasta 15 minutos",
+            "16 a 30 minutos",
+            "31 minutos a 1 hora",
+            "Más de 1 hora y hasta 2 horas",
+            "Más de 2 horas",
+        ],
+        right=True,
+    )
+
+
+def report_unmapped(values, map_name):
+    """Prints free text values not found in a recoding map,
+    so the map can be extended."""
+
+    if len(values) > 0:
+        print(
+            f"{len(values)} people with values not in {map_name}: "
+            f"{sorted(values.unique().tolist())}"
+        )
+
+
+def report_low_confidence(pred, texts, col, threshold=0.5):
+    """Prints classified free text values with confidence below threshold."""
+
+    low = pred.confidence < threshold
+    if low.sum() > 0:
+        print(
+            f"{low.sum()} {col} values classified with confidence "
+            f"below {threshold}: {sorted(texts[low[low].index].unique().tolist())}"
+        )
+
+
+def get_educ_asi(people):
     """Infer current school attending level from maximum previously
-    attained level and age."""
-
-    educ = r.EDUC
-    edad = r.Edad
-    if r.ASISTEN == 0:
-        return "Blanco por pase"
-    if educ == "Sin Educación":
-        return "Básica"
-    if educ == "Básica":
-        if edad <= 14:
-            return "Básica"
-        return "MediaSup"
-    if educ == "MediaSup":
-        if edad < 18:
-            return "MediaSup"
-        return "Superior"
-    if educ == "Superior":
-        return "Superior"
-    raise NotImplementedError
-
-
-def build_people_table(od_df, trips, add_informal=False):
-    """Builds the people table from the od survey. Cleans up many problems."""
+    attained level and age.
+
+    Returns a Series aligned with people. People attending school whose EDUC
+    is not a known level get nan and are reported.
+    """
+
+    asisten = people.ASISTEN != 0
+    educ = people.EDUC
+    edad = people.Edad
+
+    conditions = [
+        ~asisten,
+        educ == "Sin Educación",
+        (educ == "Básica") & (edad <= 14),
+        educ == "Básica",
+        (educ == "MediaSup") & (edad < 18),
+        educ == "MediaSup",
+        educ == "Superior",
+    ]
+    choices = [
+        "Blanco por pase",
+        "Básica",
+        "Básica",
+        "MediaSup",
+        "MediaSup",
+        "Superior",
+        "Superior",
+    ]
+    educ_asi = pd.Series(
+        np.select(conditions, choices, default=None), index=people.index
+    ).fillna(np.nan)
+
+    unknown = people.index[educ_asi.isna()]
+    if len(unknown) > 0:
+        print(
+            f"{len(unknown)} people attending school have unknown EDUC "
+            f"{educ[unknown].unique().tolist()}, EDUC_ASI set to nan."
+        )
+
+    return educ_asi
+
+
+def build_people_table(
+    od_df, trips, add_informal=False, classify_unmapped=False, activities=None
+):
+    """Builds the people table from the od survey. Cleans up many problems.
+
+    School and work attributes are taken from the activities summary of
+    trips, built with build_activity_summary if not given.
+
+    Free text occupations and sectors not in sector_maps are recoded by hand
+    for the 2019 survey. With classify_unmapped they are instead classified
+    with the sector_model text classifiers.
+    """
 
     people_cols = [
         "MUN",
@@ -59,15 +227,18 @@ def build_people_table(od_df, trips, add_informal=False):
         # 'FACTOR',
     ]
 
+    if activities is None:
+        activities = build_activity_summary(trips)
+
     # Agregate the people table, trust first variables
     people = od_df[people_cols].groupby(["HOGAR", "HABITANTE"]).first().copy()
     people["Ocupacion"] = people.Ocupacion.str.strip().str.lower()
 
-    # Auxiliary dataframe to find conflicting people values
-    conf_people = (
-        od_df.reset_index(level=2)[people_cols]
-        .groupby(["HOGAR", "HABITANTE"])
-        .nunique()
+    # Auxiliary long table of conflicting people values across trip rows
+    conflicts = find_conflicts(od_df, people_cols)
+    print(
+        f"{len(conflicts.index.droplevel('column').unique())} people have "
+        "conflicting values across trips."
     )
 
     # Género -> SEXO
@@ -101,10 +272,9 @@ def build_people_table(od_df, trips, add_informal=False):
 
     # Fix duplicated and missing Jefe de Familia in RELACION HOGAR
     is_head_idx = (
-        od_df.reset_index(level=2)
-        .loc[(conf_people > 1).T.sum() > 0, people_cols]
-        .query('RelaciónHogar == "Jefe(a) de familia"')
-        .index
+        conflicts.query('column == "RelaciónHogar" & value == "Jefe(a) de familia"')
+        .index.droplevel("column")
+        .unique()
     )
     people.loc[is_head_idx, "RelaciónHogar"] = "Jefe(a) de familia"
 
@@ -179,8 +349,8 @@ def build_people_table(od_df, trips, add_informal=False):
     # ASISTEN
     # People who have student as ocupation or that realize a study trip
     people["ASISTEN"] = 0
-    idx_study_trips = trips.query("Motivo == 'estudios'").index.droplevel(2).unique()
-    people.loc[idx_study_trips, "ASISTEN"] = 1
+    study = activities.query("Motivo == 'estudios'").droplevel("Motivo")
+    people.loc[study.index, "ASISTEN"] = 1
     people.loc[people.Ocupacion == "estudiante", "ASISTEN"] = 1
     # NOTE: There are still several inconsistencies
     # regarding trips start and end times and stay duration.
@@ -196,41 +366,19 @@ def build_people_table(od_df, trips, add_informal=False):
     # TAZ where they attend school
     # 15 inhabitants have two different destination zones for study trip.
     # Choose first arbitrarly
-    idx_study_trips = trips.query("Motivo == 'estudios'").index
-    taz_asi = (
-        trips.loc[idx_study_trips, "ZonaDest"].groupby(["HOGAR", "HABITANTE"]).first()
-    )
     people["TAZ_ASI"] = "Blanco por pase"
     people.loc[people.ASISTEN == 1, "TAZ_ASI"] = np.nan
-    people.loc[taz_asi.index, "TAZ_ASI"] = taz_asi
+    people.loc[study.index, "TAZ_ASI"] = study.ZonaDest
 
     # EDUC_ASI
     # EDUC reports maximum completed education level.
     # Current atending level must be estimated.
-    people["EDUC_ASI"] = "Blanco por pase"
-    people["EDUC_ASI"] = people.apply(get_educ_asi, axis=1)
+    people["EDUC_ASI"] = get_educ_asi(people)
 
     # TIE_TRASLADO_ESCU
     people["TIE_TRASLADO_ESCU"] = "Blanco por pase"
     people.loc[people.ASISTEN == 1, "TIE_TRASLADO_ESCU"] = np.nan
-    idx_study_trips = trips.query("Motivo == 'estudios'").index
-    duracion_cat = pd.cut(
-        (
-            (trips.loc[idx_study_trips, "duracion"].dt.total_seconds() / 60)
-            .groupby(["HOGAR", "HABITANTE"])
-            .max()
-        ),
-        [-1, 15, 30, 60, 120, 1e6],
-        labels=[
-            "Hasta 15 minutos",
-            "16 a 30 minutos",
-            "31 minutos a 1 hora",
-            "Más de 1 hora y hasta 2 horas",
-            "Más de 2 horas",
-        ],
-        right=True,
-    )
-    people.loc[duracion_cat.index, "TIE_TRASLADO_ESCU"] = duracion_cat
+    people.loc[study.index, "TIE_TRASLADO_ESCU"] = tie_traslado(study.duracion_max)
 
     people = people.drop(columns=["Estudios", "Estudios_O"])
 
@@ -274,15 +422,11 @@ def build_people_table(od_df, trips, add_informal=False):
     ] = None
     people.loc[people.Ocupacion_O == "no aplica", "Ocupacion_O"] = None
 
-    people.loc[
+    people = apply_overrides(
+        people,
+        "ocupacion_no_otro",
         (people.Ocupacion != "otro") & people.Ocupacion_O.notnull(),
-        ["Ocupacion", "Ocupacion_O", "SectorEconom", "SectorEconom_O"],
-    ] = [
-        ["empleado (a)", None, "servicios", None],
-        ["jubilado", None, "otro", None],
-        ["empleado (a)", None, "servicios", None],
-        ["profesionista empleado", None, "servicios", None],
-    ]
+    )
 
     people.loc[
         ((people.SectorEconom != "otro") & people.SectorEconom_O.notnull()),
@@ -674,84 +818,52 @@ def build_people_table(od_df, trips, add_informal=False):
         "ASISTEN",
     ] = 1
 
-    for r, o_list in ocu_only_map.items():
-        for ocu in o_list:
-            people.loc[
-                (
-                    (people.Ocupacion == "otro")
-                    & (people.SectorEconom_O.isna())
-                    & (people.SectorEconom == "otro")
-                    & (people.Ocupacion_O == ocu)
-                ),
-                ["Ocupacion", "Ocupacion_O", "SectorEconom", "SectorEconom_O"],
-            ] = r
-
-    people.loc[
-        ((people.Ocupacion_O.notnull())),
-        ["Ocupacion", "Ocupacion_O", "SectorEconom", "SectorEconom_O"],
-    ] = [
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["otro", None, "otro", None],
-        ["empleado (a)", None, "comercio", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "industria manufacturera", None],
-        ["empleado (a)", None, "comercio", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "comercio", None],
-        ["empleado (a)", None, "comercio", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "industria manufacturera", None],
-        ["empleado (a)", None, "comercio", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-        ["empleado (a)", None, "servicios", None],
-    ]
-
-    for secto, sect in sect_map.items():
-        people.loc[
-            ((people.SectorEconom_O == secto)), ["SectorEconom", "SectorEconom_O"]
-        ] = [sect, None]
+    ocu_cols = ["Ocupacion", "Ocupacion_O", "SectorEconom", "SectorEconom_O"]
+    cond = (
+        (people.Ocupacion == "otro")
+        & (people.SectorEconom_O.isna())
+        & (people.SectorEconom == "otro")
+        & (people.Ocupacion_O.notnull())
+    )
+    is_mapped = people.Ocupacion_O.isin(ocu_only_inv.keys())
+    report_unmapped(people.loc[cond & ~is_mapped, "Ocupacion_O"], "ocu_only_map")
+    if (cond & is_mapped).any():
+        people.loc[cond & is_mapped, ocu_cols] = [
+            ocu_only_inv[ocu] for ocu in people.loc[cond & is_mapped, "Ocupacion_O"]
+        ]
+
+    if classify_unmapped:
+        unmapped = people.Ocupacion_O.notnull()
+        ocu_pred = classify_ocupacion(people.loc[unmapped, "Ocupacion_O"])
+        report_low_confidence(ocu_pred, people.Ocupacion_O, "Ocupacion_O")
+        people.loc[unmapped, ocu_cols] = ocu_pred[ocu_cols]
+    else:
+        people = apply_overrides(people, "ocupacion_o", people.Ocupacion_O.notnull())
+
+    sect = people.SectorEconom_O.map(sect_map)
+    report_unmapped(
+        people.loc[people.SectorEconom_O.notnull() & sect.isna(), "SectorEconom_O"],
+        "sect_map",
+    )
+    people.loc[sect.notnull(), "SectorEconom"] = sect[sect.notnull()]
+    people.loc[sect.notnull(), "SectorEconom_O"] = None
 
     people.loc[
         (people.SectorEconom_O.notnull() & (people.Ocupacion == "comerciante")),
         ["Ocupacion", "SectorEconom", "SectorEconom_O"],
     ] = ["trabajador(a) por cuenta propia", "comercio", None]
 
-    people.loc[
-        (people.SectorEconom_O.notnull()),
-        ["Ocupacion", "SectorEconom", "SectorEconom_O"],
-    ] = [
-        ["trabajador(a) por cuenta propia", "comercio", None],
-        ["trabajador(a) por cuenta propia", "construcción", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "servicios", None],
-        ["trabajador(a) por cuenta propia", "servicios", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "transporte y comunicaciones", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-        ["trabajador(a) por cuenta propia", "comercio", None],
-        ["trabajador(a) por cuenta propia", "comercio", None],
-        ["trabajador(a) por cuenta propia", "construcción", None],
-        ["trabajador(a) por cuenta propia", "comercio", None],
-        ["trabajador(a) por cuenta propia", "servicios", None],
-        ["trabajador(a) por cuenta propia", "comercio", None],
-        ["trabajador(a) por cuenta propia", "construcción", None],
-        ["trabajador(a) por cuenta propia", "otro", None],
-    ]
+    if classify_unmapped:
+        unmapped = people.SectorEconom_O.notnull()
+        sect_pred = classify_sector(people.loc[unmapped, "SectorEconom_O"])
+        report_low_confidence(sect_pred, people.SectorEconom_O, "SectorEconom_O")
+        people.loc[
+            unmapped, ["Ocupacion", "SectorEconom", "SectorEconom_O"]
+        ] = sect_pred.SectorEconom.to_frame().assign(
+            Ocupacion="trabajador(a) por cuenta propia", SectorEconom_O=None
+        )
+    else:
+        people = apply_overrides(people, "sector_o", people.SectorEconom_O.notnull())
 
     people = people.drop(columns=["Ocupacion_O", "SectorEconom_O"])
 
@@ -792,33 +904,15 @@ def build_people_table(od_df, trips, add_informal=False):
 
     # TAZ_TRAB
     # Choose first arbitrarly
-    idx_work_trips = trips.query("Motivo == 'trabajo'").index
-    taz_trab = (
-        trips.loc[idx_work_trips, "ZonaDest"].groupby(["HOGAR", "HABITANTE"]).first()
-    )
+    work = activities.query("Motivo == 'trabajo'").droplevel("Motivo")
     people["TAZ_TRAB"] = "Blanco por pase"
     people.loc[people.CONACT == "Trabajó", "TAZ_TRAB"] = np.nan
-    people.loc[taz_trab.index, "TAZ_TRAB"] = taz_trab
+    people.loc[work.index, "TAZ_TRAB"] = work.ZonaDest
 
     # TIE_TRASLADO_TRAB
     people["TIE_TRASLADO_TRAB"] = "Blanco por pase"
     people.loc[people.CONACT == "Trabajó", "TIE_TRASLADO_TRAB"] = np.nan
-    idx_work_trips = trips.query("Motivo == 'trabajo'").index
-    duracion_cat = pd.cut(
-        (trips.loc[idx_work_trips, "duracion"].dt.total_seconds() / 60)
-        .groupby(["HOGAR", "HABITANTE"])
-        .max(),
-        [-1, 15, 30, 60, 120, 1e6],
-        labels=[
-            "Hasta 15 minutos",
-            "16 a 30 minutos",
-            "31 minutos a 1 hora",
-            "Más de 1 hora y hasta 2 horas",
-            "Más de 2 horas",
-        ],
-        right=True,
-    )
-    people.loc[duracion_cat.index, "TIE_TRASLADO_TRAB"] = duracion_cat
+    people.loc[work.index, "TIE_TRASLADO_TRAB"] = tie_traslado(work.duracion_max)
 
     # Drop 4 households without family head
     # people = people.drop(['22899-4', '25131-4', '3275-118', '59886-12'])
@@ -826,7 +920,7 @@ def build_people_table(od_df, trips, add_informal=False):
     people["ASISTEN"] = people.ASISTEN.replace([0.0, 1.0], ["No", "Sí"])
 
     if add_informal:
-        people = classify_job(people)
+        people["informal"] = predict_informal(people)
 
     not_first_one, not_sequential = check_sequential(people)
     print(f"In {len(not_first_one)} housholds, first inhabitant is not numbered 1.")
@@ -835,17 +929,23 @@ def build_people_table(od_df, trips, add_informal=False):
     return people
 
 
-def check_sequential(people):
-    """Check if inhabitants are sequentially enumerated."""
-    not_first_one = []
-    not_sequential = []
-    for _, (idx, df) in enumerate(people.groupby(["HOGAR"])):
-        hogar = idx[0]
-        habitantes = df.index.get_level_values(1).unique()
+def check_sequential(df, level="HABITANTE"):
+    """Check if index level (HABITANTE or VIAJE) is sequentially enumerated
+    within the groups of the preceding index levels.
+
+    Returns the index of groups whose first value is not 1 and the index of
+    groups whose values are not sequential.
+    """
+
+    levels = df.index.names[: df.index.names.index(level)]
+    values = df.index.get_level_values(level)
+    stats = (
+        pd.Series(values, index=df.index.droplevel(level))
+        .groupby(level=levels)
+        .agg(["min", "max", "nunique"])
+    )
 
-        if habitantes.min() != 1:
-            not_first_one.append(hogar)
-        if np.sum(np.diff(habitantes) != 1) > 0:
-            not_sequential.append(hogar)
+    not_first_one = stats.index[stats["min"] != 1]
+    not_sequential = stats.index[stats["max"] - stats["min"] + 1 != stats["nunique"]]
 
     return not_first_one, not_sequential
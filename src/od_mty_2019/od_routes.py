@@ -0,0 +1,128 @@
+"""Transit route ridership from the long legs table.
+
+Route identifiers in N_Ruta are free text, they are homogenized and legs are
+indexed by route. All route statistics are weighted by the trip expansion
+factor (FACTOR).
+"""
+
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from .od_modes import map_unique
+
+# Route identifiers meaning the route is unknown
+ROUTE_NAN_VALS = ["", "0", "NP", "NR", "NS", "NOSABE", "NOSE"]
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+@lru_cache(maxsize=None)
+def normalize_route(v):
+    """Homogenizes a route identifier.
+    Removes accents, case, separators and a leading Ruta or R prefix,
+    so that 'Ruta 214', 'R-214' and '214' are all '214'."""
+
+    if isinstance(v, (int, float)) and not isinstance(v, bool) and v == v:
+        v = str(int(v)) if float(v).is_integer() else str(v)
+    if not isinstance(v, str):
+        return np.nan
+
+    v = unicodedata.normalize("NFKD", v).encode("ascii", "ignore").decode().upper()
+    v = re.sub(r"^\s*(RUTA|R)[\s.\-#:]*(?=\d)", "", v)
+    v = re.sub(r"[^A-Z0-9]", "", v)
+    if v in ROUTE_NAN_VALS:
+        return np.nan
+    return v
+
+
+def quantile_rows(codes, values, weights, quantiles):
+    """Marks the rows where the weighted quantiles of each group are reached.
+
+    codes are integer group codes of the rows. The q quantile of a group is
+    the first value, in ascending order, at which its cumulative weight
+    reaches q times the group total. Rows with missing values or no weight
+    are ignored.
+    Returns an array with a row per value and a column per quantile, holding
+    the value at the row reaching the quantile of its group and nan elsewhere.
+    """
+
+    codes = np.asarray(codes)
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    marked = np.full((len(values), len(quantiles)), np.nan)
+
+    # Valid rows sorted by group, then value, so groups are contiguous
+    order = np.flatnonzero(~np.isnan(values) & (weights > 0))
+    if len(order) == 0:
+        return marked
+    order = order[np.lexsort((values[order], codes[order]))]
+    code, value, weight = codes[order], values[order], weights[order]
+
+    start = np.flatnonzero(np.r_[True, code[1:] != code[:-1]])
+    size = np.diff(np.r_[start, len(order)])
+    cum = np.cumsum(weight)
+    before = np.repeat(cum[start] - weight[start], size)
+    total = np.repeat(np.add.reduceat(weight, start), size)
+    frac = (cum - before) / total
+    prev = np.r_[0.0, frac[:-1]]
+    prev[start] = 0.0
+
+    for j, q in enumerate(quantiles):
+        reached = (frac >= q) & (prev < q)
+        marked[order[reached], j] = value[reached]
+
+    return marked
+
+
+def build_route_ridership(legs, trips, quantiles=QUANTILES):
+    """Computes transit ridership for each route.
+
+    Transit legs (MODO TPUB) are indexed by Transp and RUTA, the normalized
+    N_Ruta. For each route returns the FACTOR weighted boardings, mean and
+    quantiles of wait (TpoParada) and in vehicle (TpoAbordo) times, and the
+    share of boardings by fare payment (Pago).
+    Per leg terms are built first, all route statistics are then aggregated
+    in a single grouped pass.
+    """
+
+    by = ["Transp", "RUTA"]
+
+    tpub = legs[legs.MODO == "TPUB"].join(trips.FACTOR)
+    tpub["RUTA"] = map_unique(tpub.N_Ruta, normalize_route)
+    tpub = tpub.dropna(subset="RUTA").reset_index().set_index(by).sort_index()
+    codes = tpub.index.factorize()[0]
+
+    terms = {"TRAMOS": ("FACTOR", "size"), "ABORDAJES": ("FACTOR", "sum")}
+    means = {}
+    quantile_cols = []
+    for col in ["TpoParada", "TpoAbordo"]:
+        weight = tpub.FACTOR.where(tpub[col].notnull(), 0)
+        tpub[f"{col}_x_FACTOR"] = tpub[col] * weight
+        tpub[f"FACTOR_{col}"] = weight
+        terms[f"{col}_x_FACTOR"] = (f"{col}_x_FACTOR", "sum")
+        terms[f"FACTOR_{col}"] = (f"FACTOR_{col}", "sum")
+        means[f"{col}_media"] = (f"{col}_x_FACTOR", f"FACTOR_{col}")
+
+        # The quantile value is only set at one row per route, max picks it
+        names = [f"{col}_p{round(q * 100)}" for q in quantiles]
+        tpub[names] = quantile_rows(codes, tpub[col], tpub.FACTOR, quantiles)
+        terms.update({name: (name, "max") for name in names})
+        quantile_cols += names
+
+    pago = pd.get_dummies(tpub.Pago.astype(object), prefix="Pago", dtype=float)
+    tpub[pago.columns] = pago.mul(tpub.FACTOR, axis=0).to_numpy()
+    tpub["FACTOR_Pago"] = tpub.FACTOR.where(tpub.Pago.notnull(), 0)
+    terms.update({col: (col, "sum") for col in [*pago.columns, "FACTOR_Pago"]})
+
+    routes = tpub.groupby(level=by, observed=True).agg(**terms)
+    for name, (num, den) in means.items():
+        routes[name] = routes[num] / routes[den]
+    routes[pago.columns] = routes[pago.columns].div(routes.FACTOR_Pago, axis=0)
+
+    routes = routes[["TRAMOS", "ABORDAJES", *means, *quantile_cols, *pago.columns]]
+
+    return routes.sort_values("ABORDAJES", ascending=False)
@@ -10,6 +10,10 @@ import numpy as np
 import pandas as pd
 from matplotlib.lines import Line2D
 
+from .od_legs import wide_leg_cols
+from .od_modes import map_unique, strip_lower
+from .od_people import check_sequential
+
 
 def plot_trips(h, df):
     """Utility function to plot all trips from a household (h)."""
@@ -582,91 +586,7 @@ def build_trips(od_df):
     ]
 
     # Legs columns
-    m1_cols = [
-        "M1_Transp",
-        "M1_TipoTransp",
-        "M1_Transp_O",
-        "M1Tpo_Caminata",
-        "M1N_Ruta",
-        "M1_HHTpoParada",
-        "M1_MMTpoParada",
-        "M1_HHTpoAbordo",
-        "M1_HHTpoAbordo_O",
-        "M1_MMTpoAbordo",
-        "M1_Pago",
-    ]
-    m2_cols = [
-        "M2_Transp",
-        "M2_TpoTranspordo",
-        "M2_TipoTransp",
-        "M2_Transp_O",
-        "M2Tpo_Caminata",
-        "M2N_Ruta",
-        "M2_HHTpoParada",
-        "M2_MMTpoParada",
-        "M2_HHTpoAbordo",
-        "M2_HHTpoAbordo_O",
-        "M2_MMTpoAbordo",
-        "M2_Pago",
-    ]
-    m3_cols = [
-        "M3_Transp",
-        "M3_TpoTranspordo",
-        "M3_TipoTransp",
-        "M3_Transp_O",
-        "M3Tpo_Caminata",
-        "M3N_Ruta",
-        "M3_HHTpoParada",
-        "M3_MMTpoParada",
-        "M3_HHTpoAbordo",
-        "M3_HHTpoAbordo_O",
-        "M3_MMTpoAbordo",
-        "M3_Pago",
-    ]
-    m4_cols = [
-        "M4_Transp",
-        "M4_TpoTranspordo",
-        "M4_TipoTransp",
-        "M4_Transp_O",
-        "M4Tpo_Caminata",
-        "M4N_Ruta",
-        "M4_HHTpoParada",
-        "M4_MMTpoParada",
-        "M4_HHTpoAbordo",
-        "M4_HHTpoAbordo_O",
-        "M4_MMTpoAbordo",
-        "M4_Pago",
-    ]
-    m5_cols = [
-        "M5_Transp",
-        "M5_TpoTranspordo",
-        "M5_TipoTransp",
-        "M5_Transp_O",
-        "M5Tpo_Caminata",
-        "M5N_Ruta",
-        "M5_HHTpoParada",
-        "M5_MMTpoParada",
-        "M5_HHTpoAbordo",
-        "M5_HHTpoAbordo_O",
-        "M5_MMTpoAbordo",
-        "M5_Pago",
-    ]
-    m6_cols = [
-        "M6_Transp",
-        "M6_TpoTranspordo",
-        "M6_TipoTransp",
-        "M6_Transp_O",
-        "M6Tpo_Caminata",
-        "M6N_Ruta",
-        "M6_HHTpoParada",
-        "M6_MMTpoParada",
-        "M6_HHTpoAbordo",
-        "M6_HHTpoAbordo_O",
-        "M6_MMTpoAbordo",
-        "M6_Pago",
-    ]
-
-    m_cols = m1_cols + m2_cols + m3_cols + m4_cols + m5_cols + m6_cols
+    m_cols = wide_leg_cols()
 
     trips = od_df[trip_cols + m_cols].drop(0, level="VIAJE")
 
@@ -904,7 +824,11 @@ def build_trips(od_df):
     for hogar, habitante in habs_problems.index:
         fix_home_loc(trips, hogar, habitante)
 
-    trips["Modo Agrupado"] = trips["Modo Agrupado"].str.strip().str.lower()
+    trips["Modo Agrupado"] = map_unique(
+        trips["Modo Agrupado"],
+        strip_lower,
+        ["transporte escolar", "uber, cabify , didi o similar", "tpub"],
+    )
 
     trips.loc[
         (trips.Motivo == "estudios")
@@ -953,6 +877,9 @@ def build_trips(od_df):
 
     print(f"We have {check_overlap(trips).shape} overlapping trips.")
     print(f"We have {check_taz_chains(trips).shape} trips not chaining or-dest.")
+    not_first_one, not_sequential = check_sequential(trips, level="VIAJE")
+    print(f"For {len(not_first_one)} inhabitants, first trip is not numbered 1.")
+    print(f"For {len(not_sequential)} inhabitants, trips are not sequential.")
 
     return trips, legs_wide
 
@@ -0,0 +1,118 @@
+"""Mergeable weighted quantile sketches for travel time distributions.
+
+A sketch is a DataFrame indexed by segment (e.g. mode, route, municipality)
+with one column per logarithmic value bucket holding the sum of weights
+(FACTOR) falling in the bucket. Bucket boundaries are fixed, so sketches
+built on different partitions of the survey (household subsets, survey
+waves) are merged by adding them, and coarser segmentations are obtained by
+summing rows. Quantiles are answered from the sketch alone with a relative
+error of at most alpha, without rescanning the legs or trips tables.
+
+Example, wait time percentiles by mode from sketches built per partition
+of the legs and trips tables, segmented by mode group and mode:
+
+    parts = [legs.join(trips.FACTOR) for legs, trips in partitions]
+    sketches = [build_sketch(part, "TpoParada", ["MODO", "Transp"]) for part in parts]
+    sketch = merge_sketches(sketches)
+    sketch_quantiles(sketch, [0.5, 0.9], by=["MODO"])
+"""
+
+import numpy as np
+import pandas as pd
+
+# Default relative accuracy of quantile estimates
+ALPHA = 0.01
+
+# Bucket holding values equal or below zero
+ZERO_BUCKET = -(2**20)
+
+
+def _gamma(alpha):
+    """Ratio between consecutive bucket boundaries."""
+
+    return (1 + alpha) / (1 - alpha)
+
+
+def bucket_index(values, alpha=ALPHA):
+    """Bucket of each value, bucket i holds values in (gamma^(i-1), gamma^i].
+    Values equal or below zero go to ZERO_BUCKET."""
+
+    values = np.asarray(values, dtype=float)
+    positive = values > 0
+    idx = np.full(values.shape, ZERO_BUCKET, dtype=np.int64)
+    idx[positive] = np.ceil(np.log(values[positive]) / np.log(_gamma(alpha))).astype(
+        np.int64
+    )
+
+    return idx
+
+
+def bucket_value(idx, alpha=ALPHA):
+    """Representative value of each bucket, within alpha relative error of
+    any value in the bucket."""
+
+    idx = np.asarray(idx, dtype=np.int64)
+    gamma = _gamma(alpha)
+    value = 2 * gamma ** idx.astype(float) / (gamma + 1)
+
+    return np.where(idx == ZERO_BUCKET, 0.0, value)
+
+
+def build_sketch(df, col, by, weight="FACTOR", alpha=ALPHA):
+    """Builds the sketch of column col of df for each segment in by.
+    Timedelta columns are sketched in minutes. Rows with missing values
+    are ignored.
+
+    Returns a DataFrame indexed by by, with bucket index columns.
+    """
+
+    values = df[col]
+    if pd.api.types.is_timedelta64_dtype(values):
+        values = values.dt.total_seconds() / 60
+    valid = values.notnull() & df[weight].notnull()
+    df = df.loc[valid, by].assign(
+        BUCKET=bucket_index(values[valid], alpha), w=df.loc[valid, weight]
+    )
+
+    sketch = (
+        df.groupby(by + ["BUCKET"], observed=True)
+        .w.sum()
+        .unstack("BUCKET", fill_value=0.0)
+        .sort_index(axis=1)
+    )
+    sketch.columns.name = None
+
+    return sketch
+
+
+def merge_sketches(sketches):
+    """Merges sketches built with the same alpha and segment columns."""
+
+    sketch = pd.concat(sketches).fillna(0.0)
+    sketch = sketch.groupby(level=list(range(sketch.index.nlevels))).sum()
+
+    return sketch.sort_index(axis=1)
+
+
+def sketch_quantiles(sketch, quantiles, by=None, alpha=ALPHA):
+    """Weighted quantiles of each segment in the sketch.
+    If by is given, segments are first aggregated to those index levels.
+
+    Returns a DataFrame indexed by segment with a column per quantile.
+    """
+
+    if by is not None:
+        sketch = sketch.groupby(level=by, observed=True).sum()
+
+    weights = sketch.to_numpy()
+    cum = weights.cumsum(axis=1)
+    total = cum[:, -1:]
+    values = bucket_value(sketch.columns.to_numpy(), alpha)
+
+    result = pd.DataFrame(index=sketch.index)
+    for q in quantiles:
+        # First bucket where the cumulative weight reaches q of the total
+        first = (cum >= q * total).argmax(axis=1)
+        result[f"p{round(q * 100)}"] = np.where(total[:, 0] > 0, values[first], np.nan)
+
+    return result
@@ -0,0 +1,64 @@
+"""Model loading and chunked scoring shared by the model modules.
+
+Models are cached once per process by path and reloaded when the file
+changes, so a model retrained while the process runs is not served stale.
+Chunks of a large table are scored on a process pool with a bounded number
+of chunks in flight.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from pathlib import Path
+from pickle import load
+
+CHUNKSIZE = 100_000
+
+# Loaded models by resolved path, with the file stamp they were loaded from
+_models = {}
+
+
+def load_pickle(path):
+    """Unpickles the object in path."""
+
+    with open(path, "rb") as f:
+        return load(f)
+
+
+def load_cached(path, loader=load_pickle):
+    """Loads path with loader once per process.
+    The file is reloaded if its modification time or size changes."""
+
+    path = Path(path).resolve()
+    stat = path.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    if path not in _models or _models[path][0] != stamp:
+        _models[path] = (stamp, loader(path))
+
+    return _models[path][1]
+
+
+def map_chunks(func, chunks, *args, n_jobs=None):
+    """Yields func(chunk, *args) for each chunk, in input order.
+
+    Chunks are processed on n_jobs worker processes (all cores by default),
+    or in this process if n_jobs is 1. At most two chunks per worker are
+    pending at once, so chunks can be a generator over a file too large for
+    memory.
+    """
+
+    n_jobs = n_jobs or cpu_count()
+    if n_jobs == 1:
+        for chunk in chunks:
+            yield func(chunk, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(func, chunk, *args))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -611,3 +611,7 @@ sect_map = {
     "maquiladora": "industria manufacturera",
     "maderera": "comercio",
 }
+
+# Inverted ocu_only_map, from Ocupacion_O to the recoded
+# (Ocupacion, Ocupacion_O, SectorEconom, SectorEconom_O) values
+ocu_only_inv = {ocu: r for r, o_list in ocu_only_map.items() for ocu in o_list}
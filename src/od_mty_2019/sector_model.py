@@ -0,0 +1,136 @@
+"""Classifies free text occupations and economic sectors not in sector_maps.
+
+Character n-gram models are trained on the hand labelled Ocupacion_O and
+SectorEconom_O strings of sector_maps. The fitted models are pickled by the
+train_sector_model rule, loading them after the maps change raises an error.
+"""
+
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+from pickle import dump, load
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from .sector_maps import ocu_only_map, sect_map
+
+MODEL_PATH = Path("data/outputs/sector_model.pkl")
+
+
+def maps_hash():
+    """Hash of the training maps, used to detect stale models."""
+
+    return hashlib.sha256(repr((ocu_only_map, sect_map)).encode("utf-8")).hexdigest()
+
+
+def text_model():
+    """Character n-gram text classification pipeline."""
+
+    return Pipeline(
+        [
+            (
+                "vectorizer",
+                TfidfVectorizer(
+                    analyzer="char_wb",
+                    ngram_range=(2, 4),
+                    strip_accents="unicode",
+                    sublinear_tf=True,
+                ),
+            ),
+            ("classifier", LogisticRegression(C=10, max_iter=1000)),
+        ]
+    )
+
+
+def train_sector_model(path=MODEL_PATH):
+    """Trains the occupation and sector classifiers on sector_maps.
+    Saves models as a pickle file.
+    """
+
+    # Occupation classes are the recoded value tuples of ocu_only_map
+    ocu_labels = list(ocu_only_map)
+    ocu_text = [ocu for o_list in ocu_only_map.values() for ocu in o_list]
+    ocu_y = [i for i, o_list in enumerate(ocu_only_map.values()) for _ in o_list]
+
+    ocu_model = text_model().fit(ocu_text, ocu_y)
+    sect_model = text_model().fit(list(sect_map), list(sect_map.values()))
+
+    models = {
+        "maps_hash": maps_hash(),
+        "ocu_labels": ocu_labels,
+        "ocu_model": ocu_model,
+        "sect_model": sect_model,
+    }
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        dump(models, f, protocol=5)
+
+    return models
+
+
+@lru_cache(maxsize=None)
+def load_sector_model(path=MODEL_PATH):
+    """Loads the pickled models once per process.
+    Raises ValueError if sector_maps changed since training."""
+
+    with open(path, "rb") as f:
+        models = load(f)
+    if models["maps_hash"] != maps_hash():
+        raise ValueError(
+            f"Sector model {path} is stale, sector_maps changed since training. "
+            "Retrain it with train_sector_model."
+        )
+
+    return models
+
+
+def _predict(model, texts):
+    """Predicted class and its probability for each text."""
+
+    if len(texts) == 0:
+        return model.classes_[:0], np.zeros(0)
+    proba = model.predict_proba(texts)
+    best = proba.argmax(axis=1)
+
+    return model.classes_[best], proba[np.arange(len(texts)), best]
+
+
+def classify_ocupacion(texts, path=MODEL_PATH):
+    """Classifies Ocupacion_O strings in a single batch.
+
+    Returns a DataFrame indexed as texts with the recoded
+    Ocupacion, Ocupacion_O, SectorEconom, SectorEconom_O and the
+    classifier confidence.
+    """
+
+    texts = pd.Series(texts)
+    models = load_sector_model(path)
+    classes, confidence = _predict(models["ocu_model"], texts.tolist())
+
+    return pd.DataFrame(
+        [models["ocu_labels"][c] for c in classes],
+        index=texts.index,
+        columns=["Ocupacion", "Ocupacion_O", "SectorEconom", "SectorEconom_O"],
+    ).assign(confidence=confidence)
+
+
+def classify_sector(texts, path=MODEL_PATH):
+    """Classifies SectorEconom_O strings in a single batch.
+
+    Returns a DataFrame indexed as texts with SectorEconom and the
+    classifier confidence.
+    """
+
+    texts = pd.Series(texts)
+    models = load_sector_model(path)
+    classes, confidence = _predict(models["sect_model"], texts.tolist())
+
+    return pd.DataFrame(
+        {"SectorEconom": classes, "confidence": confidence}, index=texts.index
+    )
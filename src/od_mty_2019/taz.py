@@ -7,12 +7,16 @@ See function docstring for details.
 """
 
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from pickle import dump, load
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import shapely
 import yaml
 from matplotlib.backends.backend_pdf import PdfPages
 
@@ -70,6 +74,19 @@ mun_d = {
     51: "Villaldama",
 }
 
+TAZ_PATH = Path("data/TAZ/Zonas.gpkg")
+
+# Projected crs (INEGI Lambert, meters) of the TAZ spatial index
+TAZ_CRS = "EPSG:6372"
+
+# Version of the Marco Geoestadistico loader (load_marco_geo), stored with
+# its GeoParquet cache. Bump it when a change alters the loaded geometries.
+MARCO_GEO_VERSION = 1
+
+# Version of the overlay logic (merge_mg_taz), part of the overlay cache
+# stamp. Bump it when a change alters the overlays, to invalidate caches.
+OVERLAY_VERSION = 1
+
 met_zone = [
     "Monterrey",
     "Guadalupe",
@@ -92,21 +109,139 @@ met_zone = [
 ]
 
 
-def load_marco_geo(marco_geo_path):
+def _read_mg_layer(marco_geo_path, layer, columns, muns):
+    """Reads columns of a Marco Geoestadistico layer, only for the
+    municipalities in muns, using the Arrow I/O path."""
+
+    mun_codes = ", ".join(
+        f"'{code:03d}'" for code, name in mun_d.items() if name in set(muns)
+    )
+
+    return gpd.read_file(
+        marco_geo_path,
+        layer=layer,
+        columns=columns,
+        where=f"CVE_MUN IN ({mun_codes})",
+        engine="pyogrio",
+        use_arrow=True,
+    )
+
+
+@lru_cache(maxsize=None)
+def load_taz_index(taz_path=TAZ_PATH, crs=TAZ_CRS):
+    """Loads the TAZ in crs and builds their spatial index, once per process.
+
+    Returns the TAZ attributes (ZONA, MACROZONA, MUNICIPIO) and a STRtree
+    over their geometries, in the same order.
+    """
+
+    taz = gpd.read_file(taz_path).to_crs(crs)
+
+    return (
+        pd.DataFrame(taz[["ZONA", "MACROZONA", "MUNICIPIO"]]).reset_index(drop=True),
+        shapely.STRtree(taz.geometry.values),
+    )
+
+
+def locate_taz(x, y, crs="EPSG:4326", max_distance=None, taz_path=TAZ_PATH):
+    """Finds the TAZ of points given by arrays of coordinates x, y in crs
+    (longitude and latitude by default).
+
+    Points on a TAZ border get the first TAZ in Zonas.gpkg. If max_distance
+    (meters) is given, points outside all TAZ get the nearest TAZ within
+    that distance.
+
+    Returns a DataFrame indexed as x with ZONA, MACROZONA, MUNICIPIO and the
+    distance to the TAZ (DISTANCIA, 0 inside). Points not located, or with
+    missing coordinates, get missing values.
+    """
+
+    index = x.index if isinstance(x, pd.Series) else pd.RangeIndex(len(x))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    taz, tree = load_taz_index(taz_path)
+
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    points = gpd.GeoSeries(shapely.points(x[valid], y[valid]), crs=crs)
+    points = points.to_crs(TAZ_CRS).values.to_numpy()
+
+    zone = np.full(len(x), -1)
+    distance = np.full(len(x), np.nan)
+
+    # Points within or on the border of a TAZ, first TAZ for each point.
+    # Pairs are sorted since the query does not return them in TAZ order.
+    point_i, taz_i = tree.query(points, predicate="intersects")
+    order = np.lexsort((taz_i, point_i))
+    point_i, taz_i = point_i[order], taz_i[order]
+    point_i, first = np.unique(point_i, return_index=True)
+    zone[valid[point_i]] = taz_i[first]
+    distance[valid[point_i]] = 0.0
+
+    # Nearest TAZ fallback
+    if max_distance is not None:
+        outside = np.flatnonzero(zone[valid] < 0)
+        (point_i, taz_i), dist = tree.query_nearest(
+            points[outside],
+            max_distance=max_distance,
+            return_distance=True,
+            all_matches=False,
+        )
+        zone[valid[outside[point_i]]] = taz_i
+        distance[valid[outside[point_i]]] = dist
+
+    located = zone >= 0
+    result = pd.DataFrame(
+        {
+            "ZONA": pd.array(np.full(len(x), pd.NA), dtype="Int64"),
+            "MACROZONA": np.nan,
+            "MUNICIPIO": pd.Series([None] * len(x), dtype=object),
+            "DISTANCIA": distance,
+        }
+    )
+    result.loc[located, ["ZONA", "MACROZONA", "MUNICIPIO"]] = taz.iloc[
+        zone[located]
+    ].to_numpy()
+    result.index = index
+
+    return result
+
+
+def load_marco_geo(marco_geo_path, muns=met_zone, cache_path=None):
     """Loads AGEBS (polygon) and Localities (points) from Marco Geoestadistico
     2020 for a single state.
     Only localities that are not subdivided into AGEBs are returned, otherwise
     the composing AGEBs are returned.
 
+    Only municipalities in muns (names) and the columns used are read.
+    If cache_path is given, the result is saved there as GeoParquet and
+    read from it while it is newer than marco_geo_path, and was loaded for
+    the same muns with the same MARCO_GEO_VERSION.
+
     Does not verify population totals, for a function that loads population data
     see population synthesis repository.
 
     Returns a single GeoDataFrame indexed by Municipality, Locality and Ageb.
     """
 
+    marco_geo_path = Path(marco_geo_path)
+    # Stored as the DataFrame attrs in the parquet metadata
+    stamp = {"version": MARCO_GEO_VERSION, "muns": sorted(set(muns))}
+    if cache_path is not None:
+        cache_path = Path(cache_path)
+        if (
+            cache_path.exists()
+            and cache_path.stat().st_mtime_ns > marco_geo_path.stat().st_mtime_ns
+        ):
+            mg_concat = gpd.read_parquet(cache_path)
+            if mg_concat.attrs == stamp:
+                mg_concat.attrs = {}
+                return mg_concat
+
     # Agebs geometries
-    mg_agebs = gpd.read_file(marco_geo_path, layer="19a")
-    mg_agebs = mg_agebs.drop(columns=["CVE_ENT"])
+    mg_agebs = _read_mg_layer(
+        marco_geo_path, "19a", ["CVEGEO", "CVE_MUN", "CVE_LOC", "CVE_AGEB"], muns
+    )
     mg_agebs[["CVE_MUN", "CVE_LOC"]] = mg_agebs[["CVE_MUN", "CVE_LOC"]].astype(int)
     mg_agebs = mg_agebs.rename(
         columns={"CVE_MUN": "MUN", "CVE_LOC": "LOC", "CVE_AGEB": "AGEB"}
@@ -115,17 +250,17 @@ def load_marco_geo(marco_geo_path):
     mg_agebs = mg_agebs.set_index(["MUN", "LOC", "AGEB"]).sort_index()
 
     # Localities, polygons
-    mg_loc = gpd.read_file(marco_geo_path, layer="19l")
-    mg_loc = mg_loc.drop(columns=["CVE_ENT", "NOMGEO", "AMBITO"])
+    mg_loc = _read_mg_layer(
+        marco_geo_path, "19l", ["CVEGEO", "CVE_MUN", "CVE_LOC"], muns
+    )
     mg_loc[["CVE_MUN", "CVE_LOC"]] = mg_loc[["CVE_MUN", "CVE_LOC"]].astype(int)
     mg_loc = mg_loc.rename(columns={"CVE_MUN": "MUN", "CVE_LOC": "LOC"})
     mg_loc["MUN"] = mg_loc.MUN.map(mun_d)
     mg_loc = mg_loc.set_index(["MUN", "LOC"]).sort_index()
 
     # Localities, rural, points
-    mg_loc_pr = gpd.read_file(marco_geo_path, layer="19lpr")
-    mg_loc_pr = mg_loc_pr.drop(
-        columns=["CVE_ENT", "NOMGEO", "PLANO", "CVE_MZA", "CVE_AGEB"]
+    mg_loc_pr = _read_mg_layer(
+        marco_geo_path, "19lpr", ["CVEGEO", "CVE_MUN", "CVE_LOC"], muns
     )
     mg_loc_pr[["CVE_MUN", "CVE_LOC"]] = mg_loc_pr[["CVE_MUN", "CVE_LOC"]].astype(int)
     mg_loc_pr = mg_loc_pr.rename(columns={"CVE_MUN": "MUN", "CVE_LOC": "LOC"})
@@ -159,26 +294,70 @@ def load_marco_geo(marco_geo_path):
 
     # Remove duplicated localities, the ones that have been split
 
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        mg_concat.attrs = stamp
+        mg_concat.to_parquet(cache_path)
+        mg_concat.attrs = {}
+
     return mg_concat
 
 
+def _make_valid_polygons(geoms):
+    """Fixes invalid polygons keeping only their polygonal parts,
+    as gpd.overlay does."""
+
+    geoms = geoms.copy()
+    for i in np.flatnonzero(~shapely.is_valid(geoms)):
+        parts = shapely.get_parts(shapely.make_valid(geoms[i]))
+        geoms[i] = shapely.union_all(parts[np.isin(shapely.get_type_id(parts), [3, 6])])
+
+    return geoms
+
+
 def merge_mg_taz(mun, taz, mg):
     """For given mun (str), assign agebs/localities in mg to a TAZ in taz.
     Each geometry in mg is assigned to the TAZ for which its overlap is largest.
     If there is no overlap, the geometry is assigned to a fictious TAZ=-10.
 
+    Candidate (TAZ, geometry) pairs come from a spatial index, only the
+    intersection areas of those pairs are computed.
+
     Return a GeoDataFrame with the assignments.
     """
-    taz_mun = taz[taz.MUNICIPIO == mun].copy().drop(columns=["CVEGEO", "ESTADO"])
+    taz_mun = taz[taz.MUNICIPIO == mun].drop(columns=["CVEGEO", "ESTADO"])
     mg_mun = mg.loc[mun].copy()
 
     mg_mun["mg_AREA"] = mg_mun.area
 
-    overlay = gpd.overlay(taz_mun, mg_mun.reset_index(), keep_geom_type=False).drop(
-        columns=["MUNICIPIO", "ID", "AREA", "MACROZONA"]
+    taz_geoms = _make_valid_polygons(taz_mun.geometry.values.to_numpy())
+    mg_geoms = _make_valid_polygons(mg_mun.geometry.values.to_numpy())
+
+    # Pairs ordered by TAZ and then mg geometry, as in gpd.overlay
+    taz_i, mg_i = shapely.STRtree(mg_geoms).query(taz_geoms, predicate="intersects")
+    order = np.lexsort((mg_i, taz_i))
+    taz_i, mg_i = taz_i[order], mg_i[order]
+    intersection_area = shapely.area(
+        shapely.intersection(taz_geoms[taz_i], mg_geoms[mg_i])
     )
 
-    overlay["intersection_AREA"] = overlay.area
+    overlay = pd.concat(
+        [
+            pd.DataFrame(
+                taz_mun.drop(
+                    columns=["geometry", "MUNICIPIO", "ID", "AREA", "MACROZONA"]
+                )
+            )
+            .iloc[taz_i]
+            .reset_index(drop=True),
+            pd.DataFrame(mg_mun.drop(columns="geometry"))
+            .reset_index()
+            .iloc[mg_i]
+            .reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    overlay["intersection_AREA"] = intersection_area
 
     overlay["ratio"] = overlay.intersection_AREA / overlay.mg_AREA
     # Keep only a single mg result (CVEGEO")
@@ -191,7 +370,7 @@ def merge_mg_taz(mun, taz, mg):
     # Add unassigned mg geometries
     # Assigned all geoemtries not in a taz to taz -10
     # This way, all the population of the municipality is taken into account
-    mg_unass = mg_mun.drop(overlay.index)
+    mg_unass = pd.DataFrame(mg_mun.drop(index=overlay.index, columns="geometry"))
     mg_unass["ZONA"] = -10
     mg_unass["ratio"] = 0
 
@@ -199,9 +378,7 @@ def merge_mg_taz(mun, taz, mg):
 
     assert np.all(overlay.index == mg_mun.index)
 
-    overlay["geometry"] = mg_mun.geometry
-
-    return overlay
+    return gpd.GeoDataFrame(overlay, geometry=mg_mun.geometry, crs=mg_mun.crs)
 
 
 def plot_taz_mg(mg_gdf, taz_gdf, title, ax):
@@ -308,19 +485,93 @@ def plot_chull(taz_gdf, ax):
     ax.axis("off")
 
 
-def generate_pdf_report(taz, mg, outdir):
-    """Generates a pdf report of census geometry assignment to TAZ."""
-    overlay_dict = {}
+def _to_wkb(gdf):
+    """DataFrame with the geometry of gdf as WKB, cheap to send to workers."""
+
+    return pd.DataFrame(gdf).assign(geometry=shapely.to_wkb(gdf.geometry.values))
+
+
+def _from_wkb(df, crs):
+    """Inverse of _to_wkb."""
+
+    return gpd.GeoDataFrame(
+        df.assign(geometry=shapely.from_wkb(df.geometry.values)), crs=crs
+    )
+
+
+def _merge_mg_taz_wkb(mun, taz_mun, mg_mun, crs):
+    """merge_mg_taz on frames with WKB geometries, run in worker processes."""
+
+    overlay = merge_mg_taz(mun, _from_wkb(taz_mun, crs), _from_wkb(mg_mun, crs))
+
+    return _to_wkb(overlay)
+
+
+def compute_overlays(taz, mg, cache_dir=None, stamp=None, n_jobs=1):
+    """Assignment overlay (merge_mg_taz) of each municipality in met_zone.
+    taz must already be in the crs of mg.
+
+    If cache_dir is given, each overlay is pickled there and reused in later
+    runs while stamp, an identifier of the inputs, and OVERLAY_VERSION are
+    unchanged.
+
+    With n_jobs other than 1, overlays are computed on a pool of n_jobs
+    processes (all cores if None). Each worker receives only the geometries
+    of its municipality, as WKB.
+
+    Returns a dict of overlays by municipality, in met_zone order.
+    """
+
+    stamp = (OVERLAY_VERSION, stamp)
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def cache_path(mun):
+        return None if cache_dir is None else cache_dir / f"overlay_{mun}.pkl"
+
+    overlays = {}
+    for mun in met_zone:
+        cache = cache_path(mun)
+        if cache is not None and cache.exists():
+            with open(cache, "rb") as f:
+                cached = load(f)
+            if cached["stamp"] == stamp:
+                overlays[mun] = cached["overlay"]
+
+    missing = [mun for mun in met_zone if mun not in overlays]
+    if n_jobs == 1:
+        computed = [merge_mg_taz(mun, taz, mg) for mun in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            computed = pool.map(
+                _merge_mg_taz_wkb,
+                missing,
+                [_to_wkb(taz[taz.MUNICIPIO == mun]) for mun in missing],
+                [_to_wkb(mg.loc[[mun]]) for mun in missing],
+                [mg.crs.to_wkt()] * len(missing),
+            )
+            computed = [_from_wkb(overlay, mg.crs) for overlay in computed]
+
+    for mun, overlay in zip(missing, computed):
+        overlays[mun] = overlay
+        cache = cache_path(mun)
+        if cache is not None:
+            with open(cache, "wb") as f:
+                dump({"stamp": stamp, "overlay": overlay}, f, protocol=5)
+
+    return {mun: overlays[mun] for mun in met_zone}
+
+
+def generate_pdf_report(taz, overlays, outdir):
+    """Generates a pdf report of census geometry assignment to TAZ,
+    from the overlays of compute_overlays."""
 
-    taz_dict = {}
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         with PdfPages(outdir / "taz_assign_report.pdf") as pdf:
-            for mun in met_zone:
-                taz_mun = taz[taz.MUNICIPIO == mun].copy()
-                taz_dict[mun] = taz_mun.set_index("ZONA").sort_index()
-                overlay = merge_mg_taz(mun, taz, mg)
-                overlay_dict[mun] = overlay
+            for mun, overlay in overlays.items():
+                taz_mun = taz[taz.MUNICIPIO == mun]
 
                 _, ax = plt.subplots(2, 2, figsize=(20, 20))
 
@@ -336,14 +587,22 @@ def generate_pdf_report(taz, mg, outdir):
                 plt.close()
 
 
-def generate_taz_assignment():
-    """Utility function to genereta assignment artifacts."""
+def generate_taz_assignment(cache_dir=None, n_jobs=1):
+    """Utility function to genereta assignment artifacts.
+    Overlays are computed once for the yaml assignment and the pdf report,
+    with cache_dir they are also persisted for later runs.
+    With n_jobs other than 1, municipalities are overlaid in parallel."""
+
+    mg_path = Path("data/19_nuevoleon.gpkg")
+    taz_path = Path("data/TAZ/Zonas.gpkg")
+    stamp = tuple((p.stat().st_mtime_ns, p.stat().st_size) for p in [mg_path, taz_path])
+
+    mg = load_marco_geo(mg_path, cache_path=Path("data/outputs/marco_geo.parquet"))
+    taz = gpd.read_file(taz_path).to_crs(mg.crs)
+    overlays = compute_overlays(taz, mg, cache_dir, stamp, n_jobs)
 
-    mg = load_marco_geo(Path("data/19_nuevoleon.gpkg"))
-    taz = gpd.read_file("data/TAZ/Zonas.gpkg").to_crs(mg.crs)
     assign_dict = {}
-    for mun in met_zone:
-        overlay = merge_mg_taz(mun, taz.to_crs(mg.crs), mg)
+    for mun, overlay in overlays.items():
         assign_dict[mun] = (
             overlay.reset_index()
             .set_index("ZONA")
@@ -352,7 +611,7 @@ def generate_taz_assignment():
             .to_dict()
         )
 
-    generate_pdf_report(taz, mg, Path("data/outputs/"))
+    generate_pdf_report(taz, overlays, Path("data/outputs/"))
 
     with open("data/outputs/taz_assignment.yaml", "w", encoding="utf-8") as f:
         yaml.dump(assign_dict, f, allow_unicode=True)
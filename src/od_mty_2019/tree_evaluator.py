@@ -0,0 +1,107 @@
+"""Evaluates gradient boosted trees exported to plain numpy arrays.
+
+Predicting with the exported trees only needs numpy, so short jobs avoid
+importing scikit-learn and unpickling the model pipeline. The trees of all
+boosting iterations are concatenated in flat node arrays (feature,
+threshold, left and right child, missing values direction, leaf value), with
+the root node of each tree in root. Categorical columns are ordinal encoded
+with the categories of the fitted encoder, numeric columns pass through.
+"""
+
+import numpy as np
+
+# Rows evaluated at once, bounds the rows x trees node matrix
+CHUNKSIZE = 10_000
+
+
+def load_trees(path):
+    """Loads trees exported with informal_model.export_trees."""
+
+    with np.load(path, allow_pickle=False) as f:
+        trees = {k: f[k] for k in f.files}
+
+    trees["max_depth"] = int(trees["max_depth"])
+    trees["cat_cols"] = trees["cat_cols"].tolist()
+    trees["num_cols"] = trees["num_cols"].tolist()
+    trees["categories"] = [trees.pop(f"categories_{c}") for c in trees["cat_cols"]]
+
+    return trees
+
+
+def encode_features(trees, df):
+    """Feature matrix of df, a DataFrame or dict of columns.
+    Raises ValueError on categories unknown to the encoder."""
+
+    cols = []
+    for col, cats in zip(trees["cat_cols"], trees["categories"]):
+        values = np.asarray(df[col]).astype(str)
+        codes = np.searchsorted(cats, values).clip(max=len(cats) - 1)
+        unknown = cats[codes] != values
+        if unknown.any():
+            raise ValueError(
+                f"Found unknown categories {sorted(set(values[unknown]))} in {col}"
+            )
+        cols.append(codes.astype(np.float64))
+    for col in trees["num_cols"]:
+        cols.append(np.asarray(df[col], dtype=np.float64))
+
+    return np.column_stack(cols)
+
+
+def raw_predict(trees, X):
+    """Sum of the baseline and the leaf values of each tree, for each class
+    of the ensemble. Returns an array with a row per row of X."""
+
+    n_classes = trees["baseline"].shape[0]
+    raw = np.empty((len(X), n_classes))
+
+    for start in range(0, len(X), CHUNKSIZE):
+        x = X[start : start + CHUNKSIZE]
+        rows = np.arange(len(x))[:, None]
+        node = np.broadcast_to(trees["root"], (len(x), len(trees["root"])))
+        for _ in range(trees["max_depth"]):
+            leaf = trees["is_leaf"][node]
+            if leaf.all():
+                break
+            value = x[rows, trees["feature"][node]]
+            go_left = np.where(
+                np.isnan(value),
+                trees["missing_left"][node],
+                value <= trees["threshold"][node],
+            )
+            node = np.where(
+                leaf, node, np.where(go_left, trees["left"][node], trees["right"][node])
+            )
+
+        leaf_value = trees["value"][node]
+        for k in range(n_classes):
+            raw[start : start + len(x), k] = trees["baseline"][k] + leaf_value[
+                :, trees["tree_class"] == k
+            ].sum(axis=1)
+
+    return raw
+
+
+def predict_proba_trees(trees, df):
+    """Class probabilities of df, a DataFrame or dict of columns.
+    Columns are in the order of trees["classes"]."""
+
+    raw = raw_predict(trees, encode_features(trees, df))
+    if raw.shape[1] == 1:
+        proba = 1 / (1 + np.exp(-raw[:, 0]))
+        return np.column_stack([1 - proba, proba])
+
+    proba = np.exp(raw - raw.max(axis=1, keepdims=True))
+    return proba / proba.sum(axis=1, keepdims=True)
+
+
+def predict_trees(trees, df):
+    """Predicted labels of df, a DataFrame or dict of columns."""
+
+    raw = raw_predict(trees, encode_features(trees, df))
+    if raw.shape[1] == 1:
+        best = (raw[:, 0] > 0).astype(int)
+    else:
+        best = raw.argmax(axis=1)
+
+    return trees["classes"][best]
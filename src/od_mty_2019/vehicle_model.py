@@ -0,0 +1,187 @@
+"""Trains the household vehicle ownership model and scores synthetic
+households with it.
+
+Features are built directly as numeric arrays from the households and people
+tables, using census codes for the categorical columns, so the same model
+scores the OD households and the census synthetic population. The target is
+NumberOfVehicles (autos, pickups and motorcycles), capped at MAX_VEHICLES.
+"""
+
+from pathlib import Path
+from pickle import dump
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingClassifier
+
+from .census_codes import census_codes, encode_census
+from .scoring import CHUNKSIZE, load_cached, map_chunks
+from .taz import mun_d
+
+MODEL_PATH = Path("data/outputs/vehicle_model.pkl")
+
+# Socioeconomic levels (AMAI) from lowest to highest
+NSE_LEVELS = ["E", "D", "D+", "C-", "C", "C+", "A/B"]
+
+# Households with more vehicles are in the last class
+MAX_VEHICLES = 3
+
+# Attributes of the household head
+HEAD_COLS = ["EDAD", "EDUC", "CONACT", "SITTRA", "ACTIVIDADES_C"]
+
+FEATURES = [
+    "MUN",
+    "NSE",
+    "NUMPERS",
+    "CUADORM",
+    *HEAD_COLS,
+    "NTrabajo",
+    "NAdultos",
+    "NMenores",
+]
+
+
+def _is_coded(s):
+    """True if s already holds census codes instead of labels."""
+
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return pd.api.types.is_numeric_dtype(s.cat.categories)
+    return pd.api.types.is_numeric_dtype(s)
+
+
+def census_code_arrays(df, cols):
+    """Census codes of cols of df as a float DataFrame.
+    Label columns are encoded with encode_census."""
+
+    labels = [c for c in cols if not _is_coded(df[c])]
+    if labels:
+        df = encode_census(df[cols], {c: census_codes[c] for c in labels})
+
+    return df[cols].astype(float)
+
+
+def vehicle_features(households, people):
+    """Builds the feature matrix of the vehicle ownership model.
+
+    households is indexed by HOGAR and has the household head attributes
+    (HEAD_COLS), people is indexed by HOGAR and HABITANTE. Categorical
+    columns may hold labels or census codes, missing values are kept as nan.
+
+    Returns a float32 array with a row per household and FEATURES columns.
+    """
+
+    mun = households.MUN
+    if not _is_coded(mun):
+        mun_codes = {name.lower(): code for code, name in mun_d.items()}
+        mun = mun.str.strip().str.lower().map(mun_codes)
+
+    if "NSE" in households.columns:
+        nse_codes = {level: i for i, level in enumerate(NSE_LEVELS)}
+        nse = households.NSE.astype(str).str.strip().str.upper().map(nse_codes)
+    else:
+        nse = pd.Series(np.nan, index=households.index)
+
+    head = census_code_arrays(households, HEAD_COLS)
+
+    members = census_code_arrays(people, ["EDAD", "CONACT"])
+    edad_18 = census_codes["EDAD"]["18-24"]
+    members = (
+        pd.DataFrame(
+            {
+                "NTrabajo": members.CONACT == census_codes["CONACT"]["Trabajó"],
+                "NAdultos": members.EDAD >= edad_18,
+                "NMenores": members.EDAD < edad_18,
+            }
+        )
+        .groupby(people.index.get_level_values("HOGAR"))
+        .sum()
+        .reindex(households.index, fill_value=0)
+    )
+
+    return np.column_stack(
+        [
+            mun.to_numpy(dtype=float),
+            nse.to_numpy(dtype=float),
+            households.NUMPERS.to_numpy(dtype=float),
+            households.CUADORM.to_numpy(dtype=float),
+            head.to_numpy(),
+            members.to_numpy(dtype=float),
+        ]
+    ).astype(np.float32)
+
+
+def vehicle_target(households):
+    """Number of vehicles of each household, capped at MAX_VEHICLES."""
+
+    return np.minimum(households.NumberOfVehicles.to_numpy(), MAX_VEHICLES).astype(
+        np.int8
+    )
+
+
+def train_vehicle_model(households=None, people=None, path=MODEL_PATH):
+    """Trains the vehicle ownership model on the clean OD households.
+    Saves model as a pickle file.
+    """
+
+    opath = Path("data/outputs/od_clean/")
+    if households is None:
+        households = pd.read_csv(opath / "households.csv", index_col="HOGAR")
+    if people is None:
+        people = pd.read_csv(opath / "people.csv", index_col=["HOGAR", "HABITANTE"])
+
+    X = vehicle_features(households, people)
+    y = vehicle_target(households)
+
+    model = HistGradientBoostingClassifier(
+        max_iter=1000,
+        early_stopping=True,
+        random_state=0,
+        learning_rate=0.1,
+        max_leaf_nodes=15,
+        categorical_features=[FEATURES.index("MUN")],
+    )
+    model.fit(X, y)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        dump(model, f, protocol=5)
+
+    return model
+
+
+def load_vehicle_model(path=MODEL_PATH):
+    """Loads the pickled model once per process.
+    The model is reloaded if the file modification time or size changes."""
+
+    return load_cached(path)
+
+
+def _predict_chunk(X, path):
+    """Predicts a chunk of the feature matrix in a worker process."""
+
+    return load_vehicle_model(path).predict(X)
+
+
+def score_households(
+    households, people, path=MODEL_PATH, chunksize=CHUNKSIZE, n_jobs=None
+):
+    """Predicts the number of vehicles of each household.
+
+    The feature matrix is scored in chunks of chunksize rows on n_jobs
+    worker processes (all cores by default), each loading the model once.
+    Returns a Series indexed as households.
+    """
+
+    X = vehicle_features(households, people)
+    chunks = [X[i : i + chunksize] for i in range(0, len(X), chunksize)]
+
+    if len(chunks) <= 1:
+        n_jobs = 1
+    pred = list(map_chunks(_predict_chunk, chunks, path, n_jobs=n_jobs))
+
+    return pd.Series(
+        np.concatenate(pred) if pred else np.zeros(0, dtype=np.int8),
+        index=households.index,
+        name="NumberOfVehicles",
+    )